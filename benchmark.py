@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+"""Benchmarks and load simulation for the bot's hot paths.
+
+Runs fully offline: calendars are served from local .ics fixtures through an
+in-process HTTP transport and messages go to a fake Telegram bot, so the
+numbers measure the bot's own code rather than the network.
+
+    python benchmark.py                          # run everything, print a summary
+    python benchmark.py --output results.json    # also save the results
+    python benchmark.py --compare results.json   # compare against an earlier run
+    python benchmark.py --fixtures DIR           # use DIR/<rejon>.ics instead of generated calendars
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+from types import SimpleNamespace
+
+# Benchmark the broadcast code path, not Telegram's rate limits. Must be set
+# before bot is imported, the limits are read at import time.
+os.environ.setdefault('BROADCAST_RATE', '1000000')
+os.environ.setdefault('BROADCAST_CONCURRENCY', '50')
+
+import httpx
+
+import bot
+from test_parser import PARSER_EDGE_CASES, icalendar_events
+
+# Keep the bot's log formatting cost in the numbers, but not on the console
+for log_handler in logging.getLogger().handlers:
+    log_handler.setStream(open(os.devnull, 'w'))
+
+# Benchmarks run against the first municipality of the source registry
+REGIONS = bot.SOURCES[bot.DEFAULT_MUNICIPALITY].regions
+SOURCE = (bot.DEFAULT_MUNICIPALITY, 'I')
+
+TRASH_TYPES = ['ZMIESZANE', 'SEGREGOWANE', 'GABARYTY', 'OGRODOWE', 'Bioodpady']
+
+
+def make_calendar(rejon_no, years=3):
+    """Build a Google-style .ics: a pickup every other day for `years`, centred on today."""
+    start = date.today() - timedelta(days=365 * years // 2)
+    lines = [
+        'BEGIN:VCALENDAR', 'PRODID:-//Google Inc//Google Calendar 70.9054//EN', 'VERSION:2.0',
+        'CALSCALE:GREGORIAN', 'METHOD:PUBLISH', f'X-WR-CALNAME:Rejon {rejon_no}', 'X-WR-TIMEZONE:Europe/Warsaw'
+    ]
+    for i in range(365 * years // 2):
+        # Every rejon has a pickup tomorrow so the sweep always has work to do
+        day = start + timedelta(days=2 * i + (date.today() + timedelta(days=1) - start).days % 2)
+        lines += [
+            'BEGIN:VEVENT',
+            f'DTSTART;VALUE=DATE:{day:%Y%m%d}',
+            f'DTEND;VALUE=DATE:{day + timedelta(days=1):%Y%m%d}',
+            'DTSTAMP:20250101T000000Z',
+            f'UID:{rejon_no}-{i}@google.com',
+            'CREATED:20250101T000000Z',
+            'DESCRIPTION:',
+            'LAST-MODIFIED:20250101T000000Z',
+            'SEQUENCE:0',
+            'STATUS:CONFIRMED',
+            f'SUMMARY:{TRASH_TYPES[(i + rejon_no) % len(TRASH_TYPES)]}',
+            'TRANSP:TRANSPARENT',
+            'END:VEVENT'
+        ]
+    lines.append('END:VCALENDAR')
+    return ('\r\n'.join(lines) + '\r\n').encode()
+
+
+def load_fixtures(fixtures_dir):
+    """Return {rejon: ics bytes}, from DIR/<rejon>.ics or generated."""
+    calendars = {}
+    for rejon_no, rejon in enumerate(REGIONS, start=1):
+        if fixtures_dir:
+            with open(os.path.join(fixtures_dir, f'{rejon}.ics'), 'rb') as f:
+                calendars[rejon] = f.read()
+        else:
+            calendars[rejon] = make_calendar(rejon_no)
+    return calendars
+
+
+def install_transport(calendars):
+    """Point the bot's HTTP client at the fixtures."""
+    by_url = {url: calendars[rejon] for rejon, url in REGIONS.items()}
+
+    def handler(request):
+        return httpx.Response(200, content=by_url[str(request.url)], headers={'ETag': '"fixture"'})
+
+    bot._http_client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+def reset_calendar_cache():
+    bot._calendar_cache.clear()
+    bot._calendar_circuits.clear()
+
+
+class FakeBot:
+    """Stands in for telegram.Bot; optionally waits `latency` seconds per call."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.sent = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.sent += 1
+
+
+class FakeMessage:
+    def __init__(self):
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+
+def fake_update(user_id):
+    return SimpleNamespace(
+        effective_user=SimpleNamespace(id=user_id),
+        effective_chat=SimpleNamespace(id=user_id),
+        message=FakeMessage(),
+        callback_query=None
+    )
+
+
+def summarize(samples):
+    """Latency summary in milliseconds."""
+    samples = sorted(samples)
+
+    def pct(p):
+        return samples[min(len(samples) - 1, int(p / 100 * len(samples)))] * 1000
+
+    return {
+        'runs': len(samples),
+        'mean_ms': round(statistics.fmean(samples) * 1000, 4),
+        'p50_ms': round(pct(50), 4),
+        'p99_ms': round(pct(99), 4),
+        'max_ms': round(samples[-1] * 1000, 4)
+    }
+
+
+async def time_async(func, repeat, setup=None):
+    samples = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        started = time.perf_counter()
+        await func()
+        samples.append(time.perf_counter() - started)
+    return summarize(samples)
+
+
+def time_sync(func, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - started)
+    return summarize(samples)
+
+
+class LoopLagMonitor:
+    """Measures how late the event loop wakes up a task sleeping in short steps."""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, time.perf_counter() - started - self.interval))
+
+    def __enter__(self):
+        self._task = asyncio.ensure_future(self._run())
+        return self
+
+    def __exit__(self, *exc):
+        self._task.cancel()
+
+    def summary(self):
+        return summarize(self.samples) if self.samples else {}
+
+
+def check_parser(calendars):
+    """Compare the streaming parser with icalendar on every fixture and edge case."""
+    mismatches = []
+    calendars = {**calendars, **PARSER_EDGE_CASES}
+    for rejon, content in calendars.items():
+        if bot._parse_calendar(content) != icalendar_events(content):
+            mismatches.append(rejon)
+    return {'calendars': len(calendars), 'mismatches': mismatches}
+
+
+def seed_users(backend, count):
+    """Create `count` subscribed users in a fresh store of the given backend."""
+    rejony = list(REGIONS)
+    if backend == 'json':
+        users = {
+            str(user_id): {'rejon': rejony[user_id % len(rejony)], 'subscribed': True, 'chat_id': user_id}
+            for user_id in range(1, count + 1)
+        }
+        with open(bot.SETTINGS_FILE, 'w', encoding='utf-8') as f:
+            json.dump(users, f)
+    else:
+        store = bot.SqliteSettingsStore()
+        with store.conn:
+            store.conn.executemany(
+                'INSERT INTO users (user_id, chat_id, rejon, subscribed) VALUES (?, ?, ?, 1)',
+                ((user_id, user_id, rejony[user_id % len(rejony)]) for user_id in range(1, count + 1))
+            )
+        store.conn.close()
+    bot.SETTINGS_BACKEND = backend
+    bot.load_user_settings()
+
+
+async def bench_calendar(results, repeat):
+    results['load_schedule_from_calendar_cold'] = await time_async(
+        lambda: bot.load_schedule_from_calendar(SOURCE), repeat, setup=reset_calendar_cache
+    )
+    await bot.load_schedule_from_calendar(SOURCE)
+    results['load_schedule_from_calendar_warm'] = await time_async(
+        lambda: bot.load_schedule_from_calendar(SOURCE), repeat * 100
+    )
+    results['get_all_upcoming_pickups'] = await time_async(
+        lambda: bot.get_all_upcoming_pickups(SOURCE, days_ahead=180), repeat * 100
+    )
+    results['get_next_pickup'] = await time_async(lambda: bot.get_next_pickup(SOURCE), repeat * 100)
+
+
+def bench_settings(results, user_counts, workdir):
+    for backend in ('sqlite', 'json'):
+        for count in user_counts:
+            os.chdir(os.path.join(workdir, f'settings-{backend}-{count}'))
+            seed_users(backend, count)
+            # Rewriting the whole JSON file gets slow quickly, keep its runs short
+            repeat = 200 if backend == 'sqlite' else max(3, 2000000 // (count * 100))
+            user_ids = iter(range(count + 1, count + 1 + repeat))
+            results[f'save_user_settings_{backend}_{count}'] = time_sync(
+                lambda: bot.save_user_settings(next(user_ids), {'rejon': 'I', 'subscribed': True, 'chat_id': 1}),
+                repeat
+            )
+            if backend == 'sqlite':
+                bot.settings_store.conn.close()
+
+
+async def bench_sweep(results, user_counts, workdir, send_latency):
+    for count in user_counts:
+        os.chdir(os.path.join(workdir, f'sweep-{count}'))
+        seed_users('sqlite', count)
+        bot.delivery_ledger = bot.DeliveryLedger()
+        fake_bot = FakeBot(send_latency)
+
+        with LoopLagMonitor() as lag:
+            started = time.perf_counter()
+            await bot.send_reminders(fake_bot, list(bot.subscribers.by_slot))
+            duration = time.perf_counter() - started
+        results[f'sweep_{count}'] = {
+            'users': count,
+            'sent': fake_bot.sent,
+            'duration_ms': round(duration * 1000, 2),
+            'messages_per_s': round(fake_bot.sent / duration, 1) if duration else 0.0,
+            'loop_lag': lag.summary()
+        }
+        bot.settings_store.conn.close()
+
+
+async def bench_burst(results, workdir, burst, users):
+    """Simulate `burst` concurrent /nastepny updates from random users."""
+    os.chdir(os.path.join(workdir, 'burst'))
+    seed_users('sqlite', users)
+    context = SimpleNamespace(bot=FakeBot(), job=None)
+    latencies = []
+
+    async def one(user_id):
+        started = time.perf_counter()
+        await bot.show_next_pickup(fake_update(user_id), context)
+        latencies.append(time.perf_counter() - started)
+
+    for cache_state in ('cold', 'warm'):
+        if cache_state == 'cold':
+            reset_calendar_cache()
+        latencies.clear()
+        with LoopLagMonitor() as lag:
+            started = time.perf_counter()
+            await asyncio.gather(*(one(random.randint(1, users)) for _ in range(burst)))
+            duration = time.perf_counter() - started
+        results[f'burst_nastepny_{cache_state}'] = {
+            'updates': burst,
+            'duration_ms': round(duration * 1000, 2),
+            'handler_latency': summarize(latencies),
+            'loop_lag': lag.summary()
+        }
+    bot.settings_store.conn.close()
+
+
+async def run(args):
+    calendars = load_fixtures(args.fixtures)
+    workdir = tempfile.mkdtemp(prefix='trashbot-bench-')
+    for name in (
+        [f'settings-{b}-{n}' for b in ('sqlite', 'json') for n in args.users]
+        + [f'sweep-{n}' for n in args.users] + ['burst']
+    ):
+        os.makedirs(os.path.join(workdir, name))
+    os.chdir(workdir)
+
+    install_transport(calendars)
+    results = {'parser_equivalence': check_parser(calendars)}
+    await bench_calendar(results, args.repeat)
+    bench_settings(results, args.users, workdir)
+    await bench_sweep(results, args.users, workdir, args.send_latency)
+    await bench_burst(results, workdir, args.burst, max(args.users))
+    await bot.close_http_client()
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def headline(result):
+    """The single number used when comparing two runs of the same benchmark."""
+    for key in ('p50_ms', 'duration_ms'):
+        if key in result:
+            return key, result[key]
+    if 'handler_latency' in result:
+        return 'p99_ms', result['handler_latency']['p99_ms']
+    return None, None
+
+
+def compare(old, new):
+    print(f'\nComparison with {old["meta"].get("revision")} ({old["meta"].get("timestamp")}):')
+    for name, result in new['results'].items():
+        key, value = headline(result)
+        old_result = old['results'].get(name)
+        if key is None or old_result is None:
+            continue
+        _, old_value = headline(old_result)
+        if old_value:
+            print(f'  {name:45} {key:12} {old_value:>12.3f} -> {value:>12.3f}  ({value / old_value:.2f}x)')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--fixtures', help='directory with <rejon>.ics files (default: generated calendars)')
+    parser.add_argument('--users', type=int, nargs='+', default=[1000, 10000, 100000], help='user counts to test')
+    parser.add_argument('--repeat', type=int, default=20, help='base repetition count')
+    parser.add_argument('--burst', type=int, default=500, help='concurrent /nastepny updates to simulate')
+    parser.add_argument('--send-latency', type=float, default=0.0, help='fake send_message latency in seconds')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--compare', help='earlier results JSON to compare against')
+    args = parser.parse_args()
+    output = os.path.abspath(args.output) if args.output else None
+    baseline = os.path.abspath(args.compare) if args.compare else None
+
+    results = asyncio.run(run(args))
+    report = {
+        'meta': {
+            'revision': git_revision(),
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'args': vars(args)
+        },
+        'results': results
+    }
+    print(json.dumps(results, indent=2, ensure_ascii=False))
+
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    if baseline:
+        with open(baseline, 'r', encoding='utf-8') as f:
+            compare(json.load(f), report)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,32 @@
 import os
 import csv
 import json
+import asyncio
+import contextvars
+import functools
+import hashlib
+import heapq
+import hmac
+import io
 import logging
-import requests
-from datetime import datetime, timedelta
-from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, ConversationHandler, JobQueue
+import random
+import re
+import secrets
+import signal
+import sqlite3
+import sys
+import threading
+import time
+from contextlib import closing
+from urllib.parse import urlparse
+import httpx
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import date, datetime, timedelta
+from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+from telegram.ext import Application, CallbackQueryHandler, CommandHandler, MessageHandler, filters, ContextTypes, JobQueue
 from dotenv import load_dotenv
-from icalendar import Calendar
 
 # Load environment variables
 load_dotenv()
@@ -18,112 +37,1113 @@ logging.basicConfig(
     level=logging.INFO
 )
 logger = logging.getLogger(__name__)
+# httpx logs every request at INFO; calendar fetches are covered by metrics
+logging.getLogger('httpx').setLevel(logging.WARNING)
 
-# Conversation states
-REJON_SELECT = 1
-
-# Google Calendar iCal URLs for each rejon
-CALENDAR_URLS = {
-    'I': 'https://calendar.google.com/calendar/ical/8034430b5bb0b029fc0aa9bcd1cf22513047785a92df013d359da3945b2c5c17%40group.calendar.google.com/public/basic.ics',
-    'II': 'https://calendar.google.com/calendar/ical/163447e59ed3d7782977771f9fa2a717f47946de3633e5f4ef63cd4a2fb3a25e%40group.calendar.google.com/public/basic.ics',
-    'III': 'https://calendar.google.com/calendar/ical/f4e8f5c184fdb560d21f57f6e03f8685c2a7ecfbd30a60e703337d7dbf0b65a2%40group.calendar.google.com/public/basic.ics',
-    'IV': 'https://calendar.google.com/calendar/ical/78ebb340e73e9982c817343666befa34a923046c800625e074c3d15c9cbb471e%40group.calendar.google.com/public/basic.ics',
-    'V': 'https://calendar.google.com/calendar/ical/2496d208fb847adb47361a99815776b5f12e4897479614a1128eb421964a2b02%40group.calendar.google.com/public/basic.ics',
-    'VI': 'https://calendar.google.com/calendar/ical/6e0c91c377a80310d7532816d5ed2c8ab888d5ff455ebc396bf79e4a405f711b%40group.calendar.google.com/public/basic.ics',
-    'VII': 'https://calendar.google.com/calendar/ical/8d4c74d2494af83c965f7d126f3c38453ec0d8c52ea09f84b320f33191c6c42%40group.calendar.google.com/public/basic.ics',
-    'VIII': 'https://calendar.google.com/calendar/ical/c18e7f19cadd7f261b86a63adf500939fae036b395eda1bd7503adf4203d0162%40group.calendar.google.com/public/basic.ics',
-    'IX': 'https://calendar.google.com/calendar/ical/a82b8973d6441d79e01c58dfeb61a594765b56eea262e31423fb425b2cfd6ffd%40group.calendar.google.com/public/basic.ics',
-    'X': 'https://calendar.google.com/calendar/ical/90f17d5928aa6acced7d7f77e74fdb08f41aaa5498fce84d38b8878c194f0486%40group.calendar.google.com/public/basic.ics',
-    'XI': 'https://calendar.google.com/calendar/ical/a4b47b27961a80b1bc2761b3fcc0f47cac78b1498bcc82d56a53b3e3fa0b0049%40group.calendar.google.com/public/basic.ics',
-    'XII': 'https://calendar.google.com/calendar/ical/ac2e572bba8d66e0c00539c4a0ef1a5c60e6bb845d7599588c6af0c4c069f3a9%40group.calendar.google.com/public/basic.ics'
-}
+# Schedule entries per page of /harmonogram
+SCHEDULE_PAGE_SIZE = 15
+
+# Calendar sources, loaded from SOURCES_FILE (JSON): municipality id ->
+# {"name", "regions": {region: iCal URL}, "types": {SUMMARY: "<emoji> <name>"},
+# "default_emoji"}. Every calendar is identified by a source, the tuple
+# (municipality id, region), and fetched, cached and indexed under that key.
+SOURCES_FILE = (
+    os.getenv('SOURCES_FILE')
+    or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sources.json')
+)
+
+
+class Municipality:
+    """One town of the source registry: its regions' calendars and trash types."""
+    
+    __slots__ = ('id', 'name', 'regions', 'types', 'default_emoji')
+    
+    def __init__(self, municipality_id, config):
+        self.id = municipality_id
+        self.name = config.get('name', municipality_id)
+        self.regions = dict(config['regions'])
+        self.types = dict(config.get('types', {}))
+        self.default_emoji = config.get('default_emoji', '🗑️')
+        for region in self.regions:
+            # Telegram limits callback data to 64 bytes
+            if len(f'rejon:{municipality_id}:{region}'.encode()) > 64:
+                raise ValueError(f'Municipality/region id too long: {municipality_id}/{region}')
+    
+    def type_name(self, trash_type):
+        return self.types.get(trash_type, trash_type)
+    
+    def type_emoji(self, trash_type):
+        name = self.types.get(trash_type.upper())
+        return name.split()[0] if name else self.default_emoji
+
+
+def load_sources(path=SOURCES_FILE):
+    """Read the source registry; municipalities keep the file's order."""
+    with open(path, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+    return {municipality_id: Municipality(municipality_id, data) for municipality_id, data in config.items()}
+
+
+SOURCES = load_sources()
+# Users saved before there were several municipalities belong to the first one
+DEFAULT_MUNICIPALITY = next(iter(SOURCES))
+
+
+def source_url(source):
+    """iCal URL of a (municipality, region) source, or None if it isn't configured."""
+    municipality = SOURCES.get(source[0])
+    return municipality.regions.get(source[1]) if municipality else None
+
+
+def all_sources():
+    return [(municipality.id, region) for municipality in SOURCES.values() for region in municipality.regions]
+
+
+def source_labels(source):
+    """Metric labels of a source."""
+    return {'municipality': source[0], 'rejon': source[1]}
+
+
+# How long a fetched calendar is considered fresh (seconds). After that it is
+# still served, but revalidated in the background with ETag/Last-Modified.
+CALENDAR_CACHE_TTL = int(os.getenv('CALENDAR_CACHE_TTL', '3600'))
+
+# Only events from yesterday up to this many days ahead are kept when parsing
+CALENDAR_WINDOW_DAYS = 400
+
+# Calendars are refreshed in the background every CALENDAR_REFRESH_INTERVAL
+# seconds (+/- 10% jitter) and a few minutes before each reminder sweep
+CALENDAR_REFRESH_INTERVAL = int(os.getenv('CALENDAR_REFRESH_INTERVAL', '1800'))
+# ...and this many seconds before the next reminder slot
+SWEEP_REFRESH_LEAD = 300
+
+# How long a source's circuit stays open after failed downloads: doubles per
+# consecutive failure up to the maximum
+CALENDAR_BACKOFF_BASE = 60
+CALENDAR_BACKOFF_MAX = 3600
+
+# Seconds a handler may wait for calendar downloads in total. After that it
+# answers without the calendar; the download continues in the background.
+HANDLER_DEADLINE = float(os.getenv('HANDLER_DEADLINE', '3'))
+
+# Downloads running at once, overall and per host (many sources usually share
+# calendar.google.com). Waiting downloads queue on these semaphores.
+SOURCE_FETCH_CONCURRENCY = int(os.getenv('SOURCE_FETCH_CONCURRENCY', '16'))
+SOURCE_HOST_CONNECTIONS = int(os.getenv('SOURCE_HOST_CONNECTIONS', '4'))
+_fetch_slots = None
+_host_slots = {}
+
+# Calendar cache: source -> {'events', 'index', 'hash', 'etag',
+# 'last_modified', 'fetched_at' (monotonic, drives the TTL), 'updated_at' (wall
+# clock of the last successful download or revalidation)}
+_calendar_cache = {}
+# Circuit breakers of failing sources: source -> CircuitBreaker (closed
+# sources have none)
+_calendar_circuits = {}
+# In-flight fetches, so concurrent misses/refreshes for a source share one request
+_calendar_fetches = {}
+
+# Parsed calendars are saved here after each download and loaded on startup,
+# so the bot can answer before (or without) reaching Google
+CALENDAR_SNAPSHOT_FILE = 'calendar_snapshot.json'
+_snapshot_save_pending = False
+
+# Deadline (monotonic) of the handler running in the current task, if any
+_handler_deadline = contextvars.ContextVar('handler_deadline', default=None)
+
+# Reply when a source has no usable calendar at all
+CALENDAR_UNAVAILABLE_TEXT = (
+    '⚠️ Nie udało się pobrać kalendarza wywozów. Spróbuj ponownie za kilka minut.'
+)
+
+# Data older than this gets a warning in replies (seconds)
+CALENDAR_STALE_WARNING = 6 * 3600
 
-# Storage file for user settings
+# Rendered per-source command replies: (source, day ordinal, command) -> text.
+# Cleared at local midnight and per source when its calendar changes.
+_reply_cache = {}
+_reply_cache_day = None
+
+# Shared keep-alive HTTP client, created lazily inside the running event loop
+_http_client = None
+
+# Broadcast limits. Telegram allows roughly 30 messages/s overall and about
+# one message per second to the same chat.
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', '25'))
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', '20'))
+BROADCAST_PER_CHAT_INTERVAL = 1.0
+BROADCAST_MAX_RETRIES = 3
+# Individual sends are logged at DEBUG; INFO only gets a line every N messages
+BROADCAST_LOG_EVERY = 1000
+
+# Log of reminders already delivered, so repeated/restarted sweeps don't resend
+DELIVERY_LEDGER_FILE = 'delivery_ledger.log'
+
+# Sharded delivery: with NOTIFIER_WORKERS > 0 the sweep only queues reminders
+# in NOTIFIER_DB and `python bot.py worker <shard>` processes (one per shard,
+# 0..NOTIFIER_WORKERS-1) send them. Run a single bot process: the notifier
+# lease only keeps an old process that hasn't exited yet (during a restart)
+# from sweeping at the same time as its replacement.
+NOTIFIER_WORKERS = int(os.getenv('NOTIFIER_WORKERS', '0'))
+NOTIFIER_DB = 'notifier.db'
+NOTIFIER_LEASE_TTL = 90
+NOTIFIER_LEASE_RENEW = 30
+NOTIFIER_BATCH = 500
+NOTIFIER_POLL_INTERVAL = 2.0
+NOTIFIER_COLLECT_INTERVAL = 15
+INSTANCE_ID = f'{os.getpid()}-{secrets.token_hex(4)}'
+
+# Metrics: served as Prometheus text on http://METRICS_HOST:METRICS_PORT/metrics
+# (disabled when METRICS_PORT is empty) and/or written to METRICS_FILE every
+# minute. ADMIN_IDS (comma-separated Telegram user ids) may use /stats.
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = os.getenv('METRICS_PORT', '')
+METRICS_FILE = os.getenv('METRICS_FILE', '')
+ADMIN_IDS = {int(x) for x in os.getenv('ADMIN_IDS', '').replace(',', ' ').split()}
+
+# Webhook mode: when WEBHOOK_URL (the public HTTPS URL Telegram should call) is
+# set, updates are received by a local HTTP server on WEBHOOK_LISTEN:WEBHOOK_PORT
+# instead of long polling. Requests must carry WEBHOOK_SECRET in the
+# X-Telegram-Bot-Api-Secret-Token header (a random secret is used if unset).
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '127.0.0.1')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+
+# Update types the handlers actually consume; Telegram doesn't send the rest
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
+# Limits for the built-in HTTP server (metrics and webhook)
+HTTP_MAX_BODY = 1024 * 1024
+HTTP_READ_TIMEOUT = 10
+
+# Storage for user settings: 'sqlite' (default) or the legacy 'json' file.
+# An existing user_settings.json is imported into SQLite on first start.
+SETTINGS_BACKEND = os.getenv('SETTINGS_BACKEND', 'sqlite')
 SETTINGS_FILE = 'user_settings.json'
+SETTINGS_DB = 'user_settings.db'
 
-# Global storage for user settings (loaded from file)
-user_settings = {}
+# Reminder defaults: 9:00 (minutes after midnight), one day before the pickup.
+# Users can pick another minute and lead time (0 = on the pickup day).
+DEFAULT_REMIND_AT = 9 * 60
+DEFAULT_LEAD_DAYS = 1
+REMINDER_TIME_CHOICES = ('06:00', '07:00', '08:00', '09:00', '12:00', '16:00', '18:00', '19:00', '20:00', '21:00')
 
-# Month name mapping
-MONTHS = {
-    10: 'PAZDZIERNIK',
-    11: 'LISTOPAD',
-    12: 'GRUDZIEN'
-}
+# Active settings store (opened by load_user_settings)
+settings_store = None
 
-TRASH_TYPES = {
-    'ZMIESZANE': '🗑️ Odpady zmieszane (Mixed waste)',
-    'SEGREGOWANE': '♻️ Odpady segregowane (Segregated waste)',
-    'GABARYTY': '🛋️ Gabaryty (Large items)',
-    'OGRODOWE': '🌿 Odpady ogrodowe (Garden waste)'
-}
+# Shared queue and leases for sharded delivery (opened in main)
+outbox = None
+
+
+class Metrics:
+    """In-process counters, gauges and latency summaries.
+    
+    Each metric is keyed by name plus sorted label pairs. Summaries keep
+    count/sum/max, which is all the Prometheus text output and /stats need.
+    """
+    
+    def __init__(self, prefix='trashbot'):
+        self.prefix = prefix
+        self.counters = {}
+        self.gauges = {}
+        self.summaries = {}  # key -> [count, sum, max]
+    
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+    
+    def set(self, name, value, **labels):
+        self.gauges[(name, tuple(sorted(labels.items())))] = value
+    
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        summary = self.summaries.get(key)
+        if summary is None:
+            self.summaries[key] = [1, value, value]
+        else:
+            summary[0] += 1
+            summary[1] += value
+            if value > summary[2]:
+                summary[2] = value
+    
+    def _series(self, name, labels, suffix=''):
+        label_str = ','.join(f'{k}="{v}"' for k, v in labels)
+        return f'{self.prefix}_{name}{suffix}' + (f'{{{label_str}}}' if label_str else '')
+    
+    def render(self):
+        """Prometheus text exposition format."""
+        lines = []
+        typed = set()
+        
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {self.prefix}_{name} {kind}')
+        
+        for (name, labels), value in sorted(self.counters.items()):
+            declare(name, 'counter')
+            lines.append(f'{self._series(name, labels)} {value}')
+        for (name, labels), value in sorted(self.gauges.items()):
+            declare(name, 'gauge')
+            lines.append(f'{self._series(name, labels)} {value}')
+        for (name, labels), (count, total, _) in sorted(self.summaries.items()):
+            declare(name, 'summary')
+            lines.append(f'{self._series(name, labels, "_count")} {count}')
+            lines.append(f'{self._series(name, labels, "_sum")} {total:.6f}')
+        # Maxima are not part of the summary type, so they get their own gauges
+        for (name, labels), (_, _, peak) in sorted(self.summaries.items()):
+            declare(f'{name}_max', 'gauge')
+            lines.append(f'{self._series(name, labels, "_max")} {peak:.6f}')
+        return '\n'.join(lines) + '\n'
+    
+    def snapshot(self):
+        """Plain dict of all metrics (for the stats file)."""
+        def key(name, labels):
+            return name + ''.join(f'.{v}' for _, v in labels)
+        
+        data = {key(n, l): v for (n, l), v in self.counters.items()}
+        data.update({key(n, l): v for (n, l), v in self.gauges.items()})
+        for (name, labels), (count, total, peak) in self.summaries.items():
+            data[key(name, labels)] = {'count': count, 'avg': total / count, 'max': peak}
+        return data
+
+
+metrics = Metrics()
+
+
+def track_handler(command):
+    """Decorator recording the latency of a Telegram handler per command.
+    
+    Also starts the handler's HANDLER_DEADLINE budget for calendar downloads.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(update, context):
+            started = time.perf_counter()
+            token = _handler_deadline.set(time.monotonic() + HANDLER_DEADLINE)
+            try:
+                return await func(update, context)
+            finally:
+                _handler_deadline.reset(token)
+                metrics.observe('handler_seconds', time.perf_counter() - started, command=command)
+        return wrapper
+    return decorator
+
+
+class JsonSettingsStore:
+    """Legacy backend: all users in one JSON file, rewritten on every change."""
+    
+    def __init__(self, path=SETTINGS_FILE):
+        self.path = path
+        self.users = {}
+        try:
+            if os.path.exists(path):
+                with open(path, 'r', encoding='utf-8') as f:
+                    # Convert string keys back to integers
+                    self.users = {int(k): v for k, v in json.load(f).items()}
+        except Exception as e:
+            logger.error(f'Error loading user settings: {e}')
+            self.users = {}
+    
+    def count(self):
+        return len(self.users)
+    
+    def upsert(self, user_id, settings):
+        self.users[user_id] = settings
+        self._save()
+    
+    def set_subscribed(self, user_id, subscribed):
+        if user_id in self.users:
+            self.users[user_id]['subscribed'] = subscribed
+            self._save()
+    
+    def iter_users(self):
+        """Yield (user_id, chat_id, rejon, subscribed, remind_at, lead_days, municipality) for every user."""
+        for user_id, s in self.users.items():
+            yield (user_id, s.get('chat_id'), s.get('rejon'), bool(s.get('subscribed')),
+                   s.get('remind_at', DEFAULT_REMIND_AT), s.get('lead_days', DEFAULT_LEAD_DAYS),
+                   s.get('municipality', DEFAULT_MUNICIPALITY))
+    
+    def unsubscribe_chats(self, chat_ids):
+        chat_ids = set(chat_ids)
+        for settings in self.users.values():
+            if settings.get('chat_id') in chat_ids:
+                settings['subscribed'] = False
+        self._save()
+    
+    def _save(self):
+        """Save user settings to JSON file atomically."""
+        try:
+            # Write to temp file first, then rename (atomic operation)
+            temp_file = self.path + '.tmp'
+            with open(temp_file, 'w', encoding='utf-8') as f:
+                json.dump(self.users, f, indent=2, ensure_ascii=False)
+            os.replace(temp_file, self.path)
+        except Exception as e:
+            logger.error(f'Error saving user settings: {e}')
+
+
+class SqliteSettingsStore:
+    """SQLite backend (WAL mode): one row per user, each change is a single upsert."""
+    
+    def __init__(self, path=SETTINGS_DB):
+        self.conn = sqlite3.connect(path, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS users ('
+            'user_id INTEGER PRIMARY KEY, chat_id INTEGER, rejon TEXT, '
+            'subscribed INTEGER NOT NULL DEFAULT 1, '
+            f'remind_at INTEGER NOT NULL DEFAULT {DEFAULT_REMIND_AT}, '
+            f'lead_days INTEGER NOT NULL DEFAULT {DEFAULT_LEAD_DAYS}, '
+            'municipality TEXT)'
+        )
+    
+    def upsert(self, user_id, settings):
+        self.conn.execute(
+            'INSERT INTO users (user_id, chat_id, rejon, subscribed, remind_at, lead_days, municipality) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT (user_id) DO UPDATE SET chat_id = excluded.chat_id, rejon = excluded.rejon, '
+            'subscribed = excluded.subscribed, remind_at = excluded.remind_at, lead_days = excluded.lead_days, '
+            'municipality = excluded.municipality',
+            (user_id, settings.get('chat_id'), settings.get('rejon'), int(bool(settings.get('subscribed'))),
+             settings.get('remind_at', DEFAULT_REMIND_AT), settings.get('lead_days', DEFAULT_LEAD_DAYS),
+             settings.get('municipality', DEFAULT_MUNICIPALITY))
+        )
+    
+    def set_subscribed(self, user_id, subscribed):
+        self.conn.execute('UPDATE users SET subscribed = ? WHERE user_id = ?', (int(subscribed), user_id))
+    
+    def iter_users(self):
+        """Yield (user_id, chat_id, rejon, subscribed, remind_at, lead_days, municipality) for every user."""
+        for user_id, chat_id, rejon, subscribed, remind_at, lead_days, municipality in self.conn.execute(
+            'SELECT user_id, chat_id, rejon, subscribed, remind_at, lead_days, municipality FROM users'
+        ):
+            yield (user_id, chat_id, rejon, bool(subscribed), remind_at, lead_days,
+                   municipality or DEFAULT_MUNICIPALITY)
+    
+    def unsubscribe_chats(self, chat_ids):
+        with self.conn:
+            self.conn.executemany('UPDATE users SET subscribed = 0 WHERE chat_id = ?', [(c,) for c in chat_ids])
+    
+    def import_json(self, path):
+        """One-time migration of the legacy user_settings.json file.
+        
+        A file that can't be read raises and is left in place, so nothing is
+        lost and the migration runs again on the next start.
+        """
+        with open(path, 'r', encoding='utf-8') as f:
+            users = {int(k): v for k, v in json.load(f).items()}
+        self.conn.execute('BEGIN')
+        try:
+            for user_id, settings in users.items():
+                self.upsert(user_id, settings)
+            self.conn.execute('COMMIT')
+        except Exception:
+            self.conn.execute('ROLLBACK')
+            raise
+        os.replace(path, path + '.migrated')
+        logger.info(f'Migrated {len(users)} users from {path} to SQLite')
+
+
+class UserRecord:
+    """Settings of one user as kept in memory."""
+    
+    __slots__ = ('chat_id', 'rejon', 'subscribed', 'remind_at', 'lead_days', 'municipality')
+    
+    def __init__(self, chat_id, rejon, subscribed, remind_at=DEFAULT_REMIND_AT, lead_days=DEFAULT_LEAD_DAYS,
+                 municipality=DEFAULT_MUNICIPALITY):
+        self.chat_id = chat_id
+        self.rejon = rejon
+        self.subscribed = subscribed
+        self.remind_at = remind_at
+        self.lead_days = lead_days
+        self.municipality = municipality
+    
+    @property
+    def source(self):
+        """The (municipality, rejon) calendar this user follows."""
+        return self.municipality, self.rejon
+
+
+class SubscriberRegistry:
+    """In-memory copy of all users plus indexes of subscribed chat ids.
+    
+    Loaded once from the settings store and updated incrementally by the
+    handlers. `by_source` groups chats per (municipality, rejon) source;
+    `by_slot` groups them per reminder minute and then per (source,
+    lead_days), so a reminder sweep only
+    touches the chats due at that minute. Private chats have chat_id ==
+    user_id; the few chats shared by several users (groups) are tracked
+    separately so one member unsubscribing doesn't drop the others.
+    """
+    
+    def __init__(self):
+        self.users = {}  # user_id -> UserRecord
+        self.by_source = {}  # (municipality, rejon) -> {chat_id}
+        self.by_slot = {}  # minute of day -> {(source, lead_days): {chat_id}}
+        self.shared_chats = {}  # chat_id -> {user_id}, only for chat_id != user_id
+    
+    def load(self, rows):
+        self.users, self.by_source, self.by_slot, self.shared_chats = {}, {}, {}, {}
+        for row in rows:
+            self.set(*row)
+    
+    def __len__(self):
+        return len(self.users)
+    
+    def get(self, user_id):
+        return self.users.get(user_id)
+    
+    def set(self, user_id, chat_id, rejon, subscribed, remind_at=DEFAULT_REMIND_AT, lead_days=DEFAULT_LEAD_DAYS,
+            municipality=DEFAULT_MUNICIPALITY):
+        record = self.users.get(user_id)
+        if record is not None:
+            self._remove(user_id, record)
+            record.chat_id, record.rejon, record.subscribed = chat_id, rejon, subscribed
+            record.remind_at, record.lead_days, record.municipality = remind_at, lead_days, municipality
+        else:
+            record = self.users[user_id] = UserRecord(chat_id, rejon, subscribed, remind_at, lead_days, municipality)
+        if chat_id is not None and chat_id != user_id:
+            self.shared_chats.setdefault(chat_id, set()).add(user_id)
+        if subscribed and rejon and chat_id:
+            source = record.source
+            self.by_source.setdefault(source, set()).add(chat_id)
+            self.by_slot.setdefault(remind_at, {}).setdefault((source, lead_days), set()).add(chat_id)
+    
+    def unsubscribe(self, user_id):
+        record = self.users.get(user_id)
+        if record is not None:
+            self.set(user_id, record.chat_id, record.rejon, False, record.remind_at, record.lead_days,
+                     record.municipality)
+    
+    def unsubscribe_chats(self, chat_ids):
+        for chat_id in chat_ids:
+            for user_id in self.shared_chats.get(chat_id, set()) | {chat_id}:
+                if user_id in self.users and self.users[user_id].chat_id == chat_id:
+                    self.unsubscribe(user_id)
+    
+    def subscribed_sources(self):
+        return {source for source, chat_ids in self.by_source.items() if chat_ids}
+    
+    def subscribers(self, source):
+        return self.by_source.get(source, set())
+    
+    def slot(self, minute):
+        """{(source, lead_days): {chat_id}} of the chats reminded at `minute`."""
+        return self.by_slot.get(minute, {})
+    
+    def _shared_with(self, user_id, chat_id, matches):
+        """Whether another user of the same chat still matches an index entry."""
+        for other_id in self.shared_chats.get(chat_id, ()):
+            if matches(self.users[other_id]):
+                return True
+        owner = self.users.get(chat_id)
+        return chat_id != user_id and owner is not None and matches(owner)
+    
+    def _remove(self, user_id, record):
+        """Take a user out of the indexes before their record changes."""
+        chat_id = record.chat_id
+        if chat_id is not None and chat_id != user_id:
+            others = self.shared_chats.get(chat_id, set())
+            others.discard(user_id)
+            if not others:
+                self.shared_chats.pop(chat_id, None)
+        if not (record.subscribed and record.rejon and chat_id):
+            return
+        source, remind_at, lead_days = record.source, record.remind_at, record.lead_days
+        # Keep the chat if another user of the same chat is subscribed to the same
+        if not self._shared_with(user_id, chat_id, lambda u: u.subscribed and u.source == source):
+            self.by_source.get(source, set()).discard(chat_id)
+        if not self._shared_with(user_id, chat_id, lambda u: (
+            u.subscribed and u.source == source and u.remind_at == remind_at and u.lead_days == lead_days
+        )):
+            slot = self.by_slot.get(remind_at, {})
+            chat_ids = slot.get((source, lead_days), set())
+            chat_ids.discard(chat_id)
+            if not chat_ids:
+                slot.pop((source, lead_days), None)
+                if not slot:
+                    self.by_slot.pop(remind_at, None)
+
+
+# In-memory user registry (filled by load_user_settings)
+subscribers = SubscriberRegistry()
 
 
 def load_user_settings():
-    """Load user settings from JSON file."""
-    global user_settings
-    try:
+    """Open the configured settings store, migrating legacy JSON data if needed."""
+    global settings_store
+    if SETTINGS_BACKEND == 'json':
+        settings_store = JsonSettingsStore()
+    else:
+        settings_store = SqliteSettingsStore()
         if os.path.exists(SETTINGS_FILE):
-            with open(SETTINGS_FILE, 'r', encoding='utf-8') as f:
-                user_settings = json.load(f)
-                # Convert string keys back to integers
-                user_settings = {int(k): v for k, v in user_settings.items()}
-                logger.info(f'Loaded settings for {len(user_settings)} users')
+            try:
+                settings_store.import_json(SETTINGS_FILE)
+            except Exception as e:
+                # Don't start without the users; fix or remove the file and restart
+                logger.error(f'Error migrating user settings from {SETTINGS_FILE}: {e}')
+                raise
+    subscribers.load(settings_store.iter_users())
+    logger.info(f'Loaded settings for {len(subscribers)} users')
+
+
+def get_user_settings(user_id):
+    """Return the UserRecord of a user, or None if they never picked a rejon."""
+    return subscribers.get(user_id)
+
+
+def save_user_settings(user_id, settings):
+    """Store (insert or replace) the settings of a single user.
+    
+    Municipality, reminder time and lead days are kept from the current
+    record when `settings` doesn't include them.
+    """
+    record = subscribers.get(user_id)
+    remind_at = settings.setdefault('remind_at', record.remind_at if record else DEFAULT_REMIND_AT)
+    lead_days = settings.setdefault('lead_days', record.lead_days if record else DEFAULT_LEAD_DAYS)
+    municipality = settings.setdefault('municipality', record.municipality if record else DEFAULT_MUNICIPALITY)
+    subscribed = bool(settings.get('subscribed'))
+    subscribers.set(user_id, settings.get('chat_id'), settings.get('rejon'), subscribed, remind_at, lead_days,
+                    municipality)
+    if subscribed:
+        reminder_scheduler.add(remind_at)
+    try:
+        settings_store.upsert(user_id, settings)
     except Exception as e:
-        logger.error(f'Error loading user settings: {e}')
-        user_settings = {}
+        logger.error(f'Error saving user settings: {e}')
 
 
-def save_user_settings():
-    """Save user settings to JSON file atomically."""
+def unsubscribe_user(user_id):
+    """Turn notifications off for a single user."""
+    subscribers.unsubscribe(user_id)
     try:
-        # Write to temp file first, then rename (atomic operation)
-        temp_file = SETTINGS_FILE + '.tmp'
-        with open(temp_file, 'w', encoding='utf-8') as f:
-            json.dump(user_settings, f, indent=2, ensure_ascii=False)
-        
-        # Atomic rename
-        import shutil
-        shutil.move(temp_file, SETTINGS_FILE)
+        settings_store.set_subscribed(user_id, False)
     except Exception as e:
         logger.error(f'Error saving user settings: {e}')
 
 
-def load_schedule_from_calendar(rejon):
-    """Load trash collection schedule from Google Calendar for a specific rejon."""
-    if rejon not in CALENDAR_URLS:
-        return {}
+_ICAL_UNESCAPE = re.compile(r'\\([\\;,nN])')
+
+
+def _unescape_text(value):
+    """Undo iCal TEXT escaping (\\, \; \, \n)."""
+    return _ICAL_UNESCAPE.sub(lambda m: '\n' if m.group(1) in 'nN' else m.group(1), value)
+
+
+def _iter_ical_lines(content):
+    """Yield unfolded iCal content lines from raw bytes, one at a time."""
+    current = None
+    for raw in io.BytesIO(content):
+        raw = raw.rstrip(b'\r\n')
+        if raw[:1] in (b' ', b'\t'):
+            # Folded continuation of the previous line
+            if current is not None:
+                current += raw[1:]
+            continue
+        if current is not None:
+            yield current.decode('utf-8', errors='replace')
+        current = raw
+    if current is not None:
+        yield current.decode('utf-8', errors='replace')
+
+
+def _split_property(line):
+    """Split a content line into (upper-case name, value), ignoring parameters."""
+    colon = line.find(':')
+    if colon == -1:
+        return line.upper(), ''
+    head = line[:colon]
+    if '"' in head:
+        # A quoted parameter value may contain ':', find the real separator
+        in_quotes = False
+        for i, char in enumerate(line):
+            if char == '"':
+                in_quotes = not in_quotes
+            elif char == ':' and not in_quotes:
+                colon = i
+                break
+        head = line[:colon]
+    return head.split(';', 1)[0].upper(), line[colon + 1:]
+
+
+def _parse_calendar(content, first_day=None, last_day=None):
+    """Parse iCal content into a list of {'date', 'type'} events.
     
+    Streams over the content line by line and only looks at DTSTART and
+    SUMMARY of top-level VEVENTs (nested components such as VALARM are
+    skipped). Events outside [first_day, last_day] are dropped as soon as
+    their DTSTART is known. Dates are taken as written, which matches
+    icalendar's `dtstart.dt.date()` for DATE, floating, TZID and UTC values.
+    """
+    events = []
+    depth = 0  # nesting inside the current VEVENT (1 = its own properties)
+    skip = False  # current event is outside the window or unreadable
+    event_date = None
+    summary = ''
+    
+    for line in _iter_ical_lines(content):
+        name, value = _split_property(line)
+        if name == 'BEGIN':
+            if depth:
+                depth += 1
+            elif value.upper() == 'VEVENT':
+                depth, skip, event_date, summary = 1, False, None, ''
+            continue
+        if name == 'END':
+            if depth == 1 and event_date is not None and not skip:
+                events.append({'date': event_date, 'type': summary})
+            depth = max(depth - 1, 0)
+            continue
+        if depth != 1 or skip:
+            continue
+        
+        if name == 'DTSTART':
+            try:
+                event_date = date(int(value[0:4]), int(value[4:6]), int(value[6:8]))
+            except ValueError:
+                skip = True
+                continue
+            if (first_day and event_date < first_day) or (last_day and event_date > last_day):
+                skip = True
+        elif name == 'SUMMARY':
+            summary = _unescape_text(value)
+    
+    return events
+
+
+# Interned trash types per municipality: the index stores small ids, the
+# display names and emoji from the source registry are looked up once
+_type_ids = {}  # (municipality id, type) -> id
+_type_names = []
+_type_display = []
+_type_emoji = []
+_type_lock = threading.Lock()
+
+
+def _intern_type(municipality_id, trash_type):
+    """Return the id for a municipality's trash type, resolving its name/emoji on first use."""
+    key = (municipality_id, trash_type)
+    type_id = _type_ids.get(key)
+    if type_id is None:
+        # Parsing runs in worker threads, so new ids are handed out under a lock
+        with _type_lock:
+            type_id = _type_ids.get(key)
+            if type_id is None:
+                municipality = SOURCES.get(municipality_id)
+                type_id = len(_type_names)
+                _type_names.append(trash_type)
+                _type_display.append(municipality.type_name(trash_type) if municipality else trash_type)
+                _type_emoji.append(municipality.type_emoji(trash_type) if municipality else '🗑️')
+                _type_ids[key] = type_id
+    return type_id
+
+
+class PickupIndex:
+    """Date-sorted pickups of one source as parallel arrays of day ordinals and type ids.
+    
+    Built once per calendar download; all lookups are bisects on `days`.
+    """
+    
+    __slots__ = ('days', 'types')
+    
+    def __init__(self, events=(), municipality_id=DEFAULT_MUNICIPALITY):
+        pairs = []
+        for event in events:
+            event_date = event['date']
+            if isinstance(event_date, str):
+                event_date = datetime.strptime(event_date, '%Y-%m-%d').date()
+            pairs.append((event_date.toordinal(), _intern_type(municipality_id, event['type'])))
+        pairs.sort()
+        self.days = array('l', [day for day, _ in pairs])
+        self.types = array('H', [type_id for _, type_id in pairs])
+    
+    def __len__(self):
+        return len(self.days)
+    
+    def window(self, first_day, last_day):
+        """Positions of pickups with first_day <= day <= last_day (ordinals)."""
+        return range(bisect_left(self.days, first_day), bisect_right(self.days, last_day))
+    
+    def on(self, day):
+        """Positions of pickups on the given day ordinal."""
+        return self.window(day, day)
+    
+    def next_after(self, day):
+        """Position of the first pickup strictly after the given day ordinal, or None."""
+        pos = bisect_right(self.days, day)
+        return pos if pos < len(self.days) else None
+    
+    def pickup(self, pos, today):
+        """Materialize the pickup at a position in the dict format used by the handlers."""
+        pickup_datetime = datetime.fromordinal(self.days[pos])
+        type_id = self.types[pos]
+        return {
+            'date': pickup_datetime,
+            'type': _type_names[type_id],
+            'type_name': _type_display[type_id],
+            'type_emoji': _type_emoji[type_id],
+            'days_left': self.days[pos] - today,
+            'day_name': pickup_datetime.strftime('%A')
+        }
+
+
+_EMPTY_INDEX = PickupIndex()
+
+
+def _parse_and_index(content, municipality_id=DEFAULT_MUNICIPALITY):
+    """Parse iCal content and build its PickupIndex (runs in a worker thread).
+    
+    Only the window the bot can ask about is materialized: past events and
+    those more than CALENDAR_WINDOW_DAYS ahead are dropped while parsing.
+    """
+    today = date.today()
+    events = _parse_calendar(content, today - timedelta(days=1), today + timedelta(days=CALENDAR_WINDOW_DAYS))
+    return events, PickupIndex(events, municipality_id)
+
+
+def _get_http_client():
+    """Return the shared async HTTP client (one connection pool for all calendars)."""
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(
+            timeout=10,
+            limits=httpx.Limits(max_connections=SOURCE_FETCH_CONCURRENCY,
+                                max_keepalive_connections=SOURCE_FETCH_CONCURRENCY),
+            follow_redirects=True
+        )
+    return _http_client
+
+
+def _fetch_limits(url):
+    """Overall and per-host download semaphores (created inside the running loop)."""
+    global _fetch_slots
+    if _fetch_slots is None:
+        _fetch_slots = asyncio.Semaphore(SOURCE_FETCH_CONCURRENCY)
+    host = urlparse(url).netloc
+    if host not in _host_slots:
+        _host_slots[host] = asyncio.Semaphore(SOURCE_HOST_CONNECTIONS)
+    return _fetch_slots, _host_slots[host]
+
+
+async def close_http_client():
+    """Close the shared HTTP client."""
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
+async def _fetch_calendar(source):
+    """Fetch (or revalidate) the calendar for a source and update the cache.
+    
+    Sends If-None-Match/If-Modified-Since when we already have a copy, so an
+    unchanged calendar costs a 304 instead of a full download and re-parse.
+    A full response whose content hash didn't change is not re-parsed either,
+    so the index (and anything derived from it) is only rebuilt on real
+    changes. Parsing runs in a worker thread to keep the event loop free.
+    """
+    entry = _calendar_cache.get(source)
+    headers = {}
+    if entry:
+        if entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+    
+    url = source_url(source)
+    overall, per_host = _fetch_limits(url)
     try:
-        response = requests.get(CALENDAR_URLS[rejon], timeout=10)
-        response.raise_for_status()
+        # Wait for the host first, so sources of a busy host don't hold overall slots
+        async with per_host, overall:
+            started = time.perf_counter()
+            response = await _get_http_client().get(url, headers=headers)
+        metrics.observe('calendar_fetch_seconds', time.perf_counter() - started, **source_labels(source))
+        metrics.inc('calendar_fetch_bytes_total', len(response.content), **source_labels(source))
         
-        cal = Calendar.from_ical(response.content)
-        events = []
+        if response.status_code == 304 and entry:
+            metrics.inc('calendar_fetch_total', **source_labels(source), result='not_modified')
+            _close_circuit(source)
+            entry['fetched_at'] = time.monotonic()
+            entry['updated_at'] = time.time()
+            return entry
         
-        for component in cal.walk():
-            if component.name == "VEVENT":
-                summary = str(component.get('summary', ''))
-                dtstart = component.get('dtstart')
-                
-                if dtstart:
-                    event_date = dtstart.dt
-                    if hasattr(event_date, 'date'):
-                        event_date = event_date.date()
-                    
-                    events.append({
-                        'date': event_date,
-                        'type': summary
-                    })
+        response.raise_for_status()
+        content_hash = hashlib.sha256(response.content).hexdigest()
+        if entry and entry['hash'] == content_hash:
+            metrics.inc('calendar_fetch_total', **source_labels(source), result='unchanged')
+            _close_circuit(source)
+            entry['etag'] = response.headers.get('ETag')
+            entry['last_modified'] = response.headers.get('Last-Modified')
+            entry['fetched_at'] = time.monotonic()
+            entry['updated_at'] = time.time()
+            return entry
         
-        return events
+        parse_started = time.perf_counter()
+        events, index = await asyncio.to_thread(_parse_and_index, response.content, source[0])
+        metrics.observe('calendar_parse_seconds', time.perf_counter() - parse_started, **source_labels(source))
+    except Exception as e:
+        metrics.inc('calendar_fetch_total', **source_labels(source), result='error')
+        breaker = _calendar_circuits.setdefault(source, CircuitBreaker())
+        delay = breaker.trip()
+        logger.warning(
+            f'Error loading calendar for {source[0]}/{source[1]} '
+            f'(failure {breaker.failures}, next attempt in {delay} s): {e}'
+        )
+        # Keep serving the last good copy if we have one
+        return entry
+    
+    metrics.inc('calendar_fetch_total', **source_labels(source), result='updated')
+    _close_circuit(source)
+    invalidate_replies(source)
+    entry = _calendar_cache[source] = {
+        'events': events,
+        'index': index,
+        'hash': content_hash,
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+        'fetched_at': time.monotonic(),
+        'updated_at': time.time()
+    }
+    _schedule_snapshot_save()
+    return entry
+
+
+def _write_calendar_snapshot(snapshot):
+    """Write the calendar snapshot atomically (runs in a worker thread)."""
+    try:
+        temp_file = CALENDAR_SNAPSHOT_FILE + '.tmp'
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            json.dump(snapshot, f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(temp_file, CALENDAR_SNAPSHOT_FILE)
     except Exception as e:
-        print(f"Error loading calendar for rejon {rejon}: {e}")
-        return []
+        logger.error(f'Error saving calendar snapshot: {e}')
+
+
+def _schedule_snapshot_save():
+    """Save all cached calendars soon; downloads finishing together share one write."""
+    global _snapshot_save_pending
+    if _snapshot_save_pending:
+        return
+    _snapshot_save_pending = True
+    
+    async def save():
+        global _snapshot_save_pending
+        await asyncio.sleep(1)
+        _snapshot_save_pending = False
+        snapshot = {
+            f'{source[0]}/{source[1]}': {
+                'days': list(entry['index'].days),
+                'types': [_type_names[type_id] for type_id in entry['index'].types],
+                'hash': entry['hash'],
+                'etag': entry['etag'],
+                'last_modified': entry['last_modified'],
+                'updated_at': entry['updated_at']
+            }
+            for source, entry in _calendar_cache.items()
+        }
+        await asyncio.to_thread(_write_calendar_snapshot, snapshot)
+    
+    asyncio.ensure_future(save())
+
+
+def load_calendar_snapshot():
+    """Fill the calendar cache from the last snapshot.
+    
+    Entries keep their original age, so anything older than the TTL is
+    served immediately and revalidated in the background on first use.
+    """
+    try:
+        if not os.path.exists(CALENDAR_SNAPSHOT_FILE):
+            return
+        with open(CALENDAR_SNAPSHOT_FILE, 'r', encoding='utf-8') as f:
+            snapshot = json.load(f)
+    except Exception as e:
+        logger.error(f'Error loading calendar snapshot: {e}')
+        return
+    
+    now = time.time()
+    for key, data in snapshot.items():
+        municipality_id, _, region = key.partition('/')
+        source = (municipality_id, region)
+        if source_url(source) is None:
+            continue
+        events = [
+            {'date': date.fromordinal(day), 'type': trash_type}
+            for day, trash_type in zip(data['days'], data['types'])
+        ]
+        age = max(0.0, now - data['updated_at'])
+        _calendar_cache[source] = {
+            'events': events,
+            'index': PickupIndex(events, source[0]),
+            'hash': data.get('hash'),
+            'etag': data['etag'],
+            'last_modified': data['last_modified'],
+            'fetched_at': time.monotonic() - age,
+            'updated_at': data['updated_at']
+        }
+    logger.info(f'Loaded calendar snapshot for {len(_calendar_cache)} sources')
+
+
+def calendar_age(source):
+    """Seconds since the source's calendar was last confirmed, or None if never loaded."""
+    entry = _calendar_cache.get(source)
+    return time.time() - entry['updated_at'] if entry else None
+
+
+def stale_notice(source):
+    """Warning line for replies built from outdated calendar data ('' if fresh)."""
+    age = calendar_age(source)
+    if age is None or age < CALENDAR_STALE_WARNING:
+        return ''
+    updated = datetime.fromtimestamp(time.time() - age).strftime('%d.%m.%Y %H:%M')
+    return f'\n\n⚠️ Nie udało się pobrać aktualnego kalendarza, dane z {updated}'
+
 
+def _start_fetch(source):
+    """Return the in-flight fetch task for a source, starting one if needed."""
+    task = _calendar_fetches.get(source)
+    if task is None:
+        task = asyncio.ensure_future(_fetch_calendar(source))
+        _calendar_fetches[source] = task
+        task.add_done_callback(lambda _: _calendar_fetches.pop(source, None))
+    return task
 
+
+class CircuitBreaker:
+    """Failure state of one calendar source.
+    
+    After a failed download the circuit is open: the source is not requested
+    and handlers answer from the last good copy (or say the calendar is
+    unavailable) right away. When the delay is over it is half-open and the
+    next refresh or cache miss goes through as a probe; a success closes the
+    circuit, a failure opens it again for twice as long.
+    """
+    
+    __slots__ = ('failures', 'retry_at')
+    
+    def __init__(self):
+        self.failures = 0
+        self.retry_at = 0.0
+    
+    def trip(self):
+        """Record a failure and open the circuit; returns the delay in seconds."""
+        self.failures += 1
+        delay = min(CALENDAR_BACKOFF_BASE * 2 ** (self.failures - 1), CALENDAR_BACKOFF_MAX)
+        self.retry_at = time.monotonic() + delay
+        return delay
+    
+    @property
+    def state(self):
+        return 'open' if time.monotonic() < self.retry_at else 'half_open'
+
+
+CIRCUIT_STATES = ('closed', 'half_open', 'open')
+
+
+def circuit_state(source):
+    """'closed', 'open' or 'half_open'."""
+    breaker = _calendar_circuits.get(source)
+    return breaker.state if breaker else 'closed'
+
+
+def _circuit_open(source):
+    return circuit_state(source) == 'open'
+
+
+def _close_circuit(source):
+    breaker = _calendar_circuits.pop(source, None)
+    if breaker is not None:
+        logger.info(f'Calendar for {source[0]}/{source[1]} loaded again after {breaker.failures} failures')
+
+
+async def refresh_calendars(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Refresh all calendars in the background (JobQueue callback).
+    
+    Sources with an open circuit are skipped. A job with data {'repeat': True}
+    reschedules itself with a jittered delay, so refreshes don't line up
+    with other periodic traffic.
+    """
+    sources = [source for source in all_sources() if not _circuit_open(source)]
+    await asyncio.gather(*(_start_fetch(source) for source in sources))
+    
+    job_data = context.job.data if context.job else None
+    if job_data and job_data.get('repeat'):
+        delay = CALENDAR_REFRESH_INTERVAL * random.uniform(0.9, 1.1)
+        context.job_queue.run_once(refresh_calendars, when=delay, name='calendar_refresh', data=job_data)
+
+
+async def _get_calendar_entry(source):
+    """Return the cache entry for a source, or None if the calendar is unavailable.
+    
+    Calendars are normally kept fresh by refresh_calendars, so this is a dict
+    lookup. Stale entries are still returned immediately while a refresh runs
+    in the background, concurrent misses for the same source share a single
+    download, and a source with an open circuit and no data fails fast.
+    Inside a handler a miss waits at most until the handler's deadline.
+    """
+    entry = _calendar_cache.get(source)
+    if entry:
+        if time.monotonic() - entry['fetched_at'] >= CALENDAR_CACHE_TTL:
+            metrics.inc('calendar_cache_total', result='stale')
+            if not _circuit_open(source):
+                _start_fetch(source)
+        else:
+            metrics.inc('calendar_cache_total', result='hit')
+        return entry
+    metrics.inc('calendar_cache_total', result='miss')
+    if _circuit_open(source):
+        return None
+    
+    # shield() so one cancelled caller doesn't cancel the fetch for the others
+    fetch = asyncio.shield(_start_fetch(source))
+    deadline = _handler_deadline.get()
+    if deadline is None:
+        return await fetch
+    try:
+        return await asyncio.wait_for(fetch, max(0.0, deadline - time.monotonic()))
+    except asyncio.TimeoutError:
+        metrics.inc('handler_deadline_exceeded_total', **source_labels(source))
+        return None
+
+
+async def load_schedule_from_calendar(source):
+    """Load trash collection schedule from Google Calendar for a specific source."""
+    if source_url(source) is None:
+        return {}
+    
+    entry = await _get_calendar_entry(source)
+    return entry['events'] if entry else []
+
+
+class CalendarUnavailable(Exception):
+    """A source has no calendar data: never downloaded and currently failing."""
+
+
+async def get_pickup_index(source):
+    """Return the compiled PickupIndex for a source.
+    
+    Unknown sources have an empty index; raises CalendarUnavailable if the
+    calendar couldn't be loaded (within the handler's deadline).
+    """
+    if source_url(source) is None:
+        return _EMPTY_INDEX
+    
+    entry = await _get_calendar_entry(source)
+    if entry is None:
+        metrics.inc('calendar_unavailable_total', **source_labels(source))
+        raise CalendarUnavailable(source)
+    return entry['index']
+
+
+@functools.cache
 def load_schedule():
-    """Load trash collection schedule from CSV file (fallback/legacy method)."""
+    """Load trash collection schedule from CSV file (fallback/legacy method).
+    
+    The file only changes with a deploy, so it is read once per process.
+    """
     schedule_data = {}
     csv_path = os.path.join(os.path.dirname(__file__), 'trash_schedule.csv')
     
@@ -148,221 +1168,488 @@ def load_schedule():
     return schedule_data
 
 
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Start the conversation and ask for rejon selection."""
-    keyboard = [
-        ['I', 'II', 'III'],
-        ['IV', 'V', 'VI'],
-        ['VII', 'VIII', 'IX'],
-        ['X', 'XI', 'XII']
-    ]
-    reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True, resize_keyboard=True)
-    
-    await update.message.reply_text(
-        '👋 Witaj w Bocie Powiadomień o Wywozie Śmieci!\n\n'
-        'Wybierz swój REJON (I-XII):',
-        reply_markup=reply_markup
-    )
-    
-    return REJON_SELECT
+def invalidate_replies(source=None):
+    """Forget rendered replies for one source (after a calendar change), or all."""
+    if source is None:
+        _reply_cache.clear()
+        return
+    for key in [key for key in _reply_cache if key[0] == source]:
+        del _reply_cache[key]
 
 
-async def rejon_selected(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Handle rejon selection and show schedule."""
-    user_id = update.effective_user.id
-    rejon = update.message.text.strip()
+async def render_reply(source, command):
+    """Return the reply for a per-source command, rendered once per day.
     
-    if rejon not in CALENDAR_URLS:
-        await update.message.reply_text('❌ Nieprawidłowy rejon. Wybierz I-XII.')
-        return REJON_SELECT
+    Replies only depend on the source's calendar and today's date, so every
+    user of a (municipality, rejon) shares one rendering until midnight or until the
+    calendar changes. Replies built while the calendar is unavailable are
+    not remembered.
+    """
+    global _reply_cache_day
+    today = date.today().toordinal()
+    if _reply_cache_day != today:
+        _reply_cache.clear()
+        _reply_cache_day = today
     
-    # Save user settings with subscription enabled
-    user_settings[user_id] = {
-        'rejon': rejon,
-        'subscribed': True,
-        'chat_id': update.effective_chat.id
-    }
-    save_user_settings()
-    
-    # Load and display schedule
-    schedule_data = load_schedule()
-    rejon_schedule = schedule_data.get(rejon, {})
-    
-    message = f'✅ Wybrany REJON: {rejon}\n\n'
-    message += '📅 Harmonogram wywozu śmieci:\n\n'
-    
-    for trash_type, dates in rejon_schedule.items():
-        message += f'{TRASH_TYPES.get(trash_type, trash_type)}:\n'
-        message += f'  🍂 Październik: {", ".join(dates["PAZDZIERNIK"])}\n'
-        message += f'  🍁 Listopad: {", ".join(dates["LISTOPAD"])}\n'
-        message += f'  ❄️ Grudzień: {", ".join(dates["GRUDZIEN"])}\n\n'
-    
-    await update.message.reply_text(message, reply_markup=ReplyKeyboardRemove())
-    
-    # Check if there's a pickup tomorrow and notify immediately
-    tomorrow = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
-    all_pickups = get_all_upcoming_pickups(rejon, days_ahead=2)
-    tomorrow_pickups = [p for p in all_pickups if p['date'].date() == tomorrow.date()]
-    
-    if tomorrow_pickups:
-        for pickup in tomorrow_pickups:
-            notification_msg = (
-                f'🔔 PRZYPOMNIENIE O WYWOZIE ŚMIECI 🔔\n\n'
-                f'Jutro, {pickup["date"].strftime("%d.%m.%Y")} ({pickup["day_name"]})\n'
-                f'będzie wywóz:\n\n'
-                f'{pickup["type_emoji"]} {TRASH_TYPES.get(pickup["type"], pickup["type"])}\n\n'
-                f'Pamiętaj aby wystawić odpady! 🗑️'
-            )
-            await update.message.reply_text(notification_msg)
-    
-    # Show next pickup
-    next_pickup = get_next_pickup(rejon)
-    if next_pickup:
-        await update.message.reply_text(
-            f'🔔 Najbliższy wywóz:\n'
-            f'{next_pickup["type_emoji"]} {TRASH_TYPES.get(next_pickup["type"], next_pickup["type"])}\n'
-            f'📅 Data: {next_pickup["date"].strftime("%d.%m.%Y")} ({next_pickup["day_name"]})\n'
-            f'⏰ Za {next_pickup["days_left"]} dni'
+    key = (source, today, command)
+    text = _reply_cache.get(key)
+    if text is not None:
+        metrics.inc('reply_cache_total', result='hit')
+        return text
+    metrics.inc('reply_cache_total', result='miss')
+    text = await _REPLY_RENDERERS[command](source)
+    if command == 'csv_schedule' or source in _calendar_cache:
+        _reply_cache[key] = text
+    return text
+
+
+async def _render_csv_schedule(source):
+    """Legacy CSV schedule section, or an empty string without CSV data."""
+    municipality_id, rejon = source
+    if municipality_id != DEFAULT_MUNICIPALITY:
+        return ''
+    lines = []
+    for trash_type, dates in load_schedule().get(rejon, {}).items():
+        lines.append(
+            f'{SOURCES[DEFAULT_MUNICIPALITY].type_name(trash_type)}:\n'
+            f'  🍂 Październik: {", ".join(dates["PAZDZIERNIK"])}\n'
+            f'  🍁 Listopad: {", ".join(dates["LISTOPAD"])}\n'
+            f'  ❄️ Grudzień: {", ".join(dates["GRUDZIEN"])}\n\n'
         )
+    return ''.join(lines)
+
+
+async def _render_schedule(source):
+    """Tuple of /harmonogram pages, SCHEDULE_PAGE_SIZE pickups each."""
+    rejon = source[1]
+    upcoming_pickups = await get_all_upcoming_pickups(source, days_ahead=180)
+    if not upcoming_pickups:
+        return (f'📅 Brak zaplanowanych wywozów dla REJON {rejon}',)
     
-    await update.message.reply_text(
-        '🔔 Powiadomienia zostały włączone!\n\n'
-        'Otrzymasz przypomnienie jeden dzień przed każdym wywozem śmieci.\n\n'
+    pages = []
+    total = len(upcoming_pickups)
+    for first in range(0, total, SCHEDULE_PAGE_SIZE):
+        lines = [f'📅 Harmonogram wywozu śmieci - REJON {rejon}\n\nNajbliższe wywozy:\n\n']
+        for pickup in upcoming_pickups[first:first + SCHEDULE_PAGE_SIZE]:
+            date_str = pickup['date'].strftime('%d.%m.%Y (%A)')
+            lines.append(f'{pickup["type_emoji"]} {date_str} - {pickup["type"]}\n')
+        if total > SCHEDULE_PAGE_SIZE:
+            lines.append(f'\n{first + 1}-{min(first + SCHEDULE_PAGE_SIZE, total)} z {total} wywozów')
+        pages.append(''.join(lines))
+    return tuple(pages)
+
+
+async def _render_next_pickup(source):
+    """Empty string when nothing is scheduled."""
+    next_pickup = await get_next_pickup(source)
+    if not next_pickup:
+        return ''
+    return (
+        f'🔔 Najbliższy wywóz:\n'
+        f'{next_pickup["type_emoji"]} {next_pickup["type_name"]}\n'
+        f'📅 Data: {next_pickup["date"].strftime("%d.%m.%Y")} ({next_pickup["day_name"]})\n'
+        f'⏰ Za {next_pickup["days_left"]} dni'
+    )
+
+
+async def _render_tomorrow(source):
+    """Reminder for tomorrow's pickups, or an empty string if there are none."""
+    tomorrow_pickups = await get_pickups_on(source, date.today() + timedelta(days=1))
+    return render_reminder(tomorrow_pickups) if tomorrow_pickups else ''
+
+
+async def _render_selection(source):
+    """The single reply after choosing a rejon."""
+    municipality_id, rejon = source
+    parts = [f'✅ Wybrany REJON: {rejon}']
+    if len(SOURCES) > 1:
+        parts[0] = f'✅ {SOURCES[municipality_id].name}, REJON {rejon}'
+    csv_schedule = await render_reply(source, 'csv_schedule')
+    if csv_schedule:
+        parts.append(f'📅 Harmonogram wywozu śmieci:\n\n{csv_schedule.rstrip()}')
+    try:
+        for command in ('jutro', 'nastepny'):
+            text = await render_reply(source, command)
+            if text:
+                parts.append(text)
+    except CalendarUnavailable:
+        parts.append(CALENDAR_UNAVAILABLE_TEXT)
+    return '\n\n'.join(parts)
+
+
+def selection_footer(record):
+    """End of the rejon summary; per user (it names their reminder time), so never cached."""
+    return (
+        '🔔 Powiadomienia zostały włączone!\n'
+        f'Otrzymasz przypomnienie przed każdym wywozem śmieci ({describe_reminder(record)}).\n\n'
         'Dostępne komendy:\n'
         '/harmonogram - Pokaż pełny harmonogram\n'
         '/nastepny - Pokaż najbliższy wywóz\n'
+        '/przypomnienie - Ustaw godzinę przypomnienia\n'
         '/zmien - Zmień rejon\n'
         '/stop - Wyłącz powiadomienia\n'
         '/help - Pomoc'
     )
+
+
+_REPLY_RENDERERS = {
+    'wybor': _render_selection,
+    'csv_schedule': _render_csv_schedule,
+    'harmonogram': _render_schedule,
+    'nastepny': _render_next_pickup,
+    'jutro': _render_tomorrow,
+}
+
+
+def region_keyboard(municipality):
+    """Three rejon buttons per row for one municipality."""
+    buttons = [
+        InlineKeyboardButton(region, callback_data=f'rejon:{municipality.id}:{region}')
+        for region in municipality.regions
+    ]
+    return InlineKeyboardMarkup([buttons[i:i + 3] for i in range(0, len(buttons), 3)])
+
+
+REJON_KEYBOARDS = {municipality_id: region_keyboard(m) for municipality_id, m in SOURCES.items()}
+
+# With a single municipality the rejon is chosen right away
+if len(SOURCES) > 1:
+    START_KEYBOARD = InlineKeyboardMarkup([
+        [InlineKeyboardButton(m.name, callback_data=f'gmina:{m.id}')] for m in SOURCES.values()
+    ])
+    START_PROMPT = 'Wybierz swoją gminę:'
+else:
+    START_KEYBOARD = REJON_KEYBOARDS[DEFAULT_MUNICIPALITY]
+    START_PROMPT = 'Wybierz swój REJON:'
+
+SUBSCRIBED_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton('📅 Harmonogram', callback_data='page:0'),
+     InlineKeyboardButton('🔄 Zmień rejon', callback_data='zmien')],
+    [InlineKeyboardButton('⏰ Godzina przypomnienia', callback_data='przypomnienie'),
+     InlineKeyboardButton('🔕 Wyłącz', callback_data='stop')]
+])
+
+UNSUBSCRIBED_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton('🔔 Włącz ponownie', callback_data='sub')]
+])
+
+
+def schedule_keyboard(page, pages):
+    """Previous/next buttons for a /harmonogram page (None for a single page)."""
+    if pages <= 1:
+        return None
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton('◀️', callback_data=f'page:{page - 1}'))
+    buttons.append(InlineKeyboardButton(f'{page + 1}/{pages}', callback_data=f'page:{page}'))
+    if page < pages - 1:
+        buttons.append(InlineKeyboardButton('▶️', callback_data=f'page:{page + 1}'))
+    return InlineKeyboardMarkup([buttons])
+
+
+async def _edit_or_reply(update, text, reply_markup=None):
+    """Edit the message a button belongs to, or reply to a command message."""
+    query = update.callback_query
+    if query is None:
+        await update.message.reply_text(text, reply_markup=reply_markup)
+        return
+    await query.answer()
+    try:
+        await query.edit_message_text(text, reply_markup=reply_markup)
+    except BadRequest as e:
+        # Pressing the button of the page already shown
+        if 'not modified' not in str(e).lower():
+            raise
+
+
+def format_minute(minute):
+    return f'{minute // 60:02d}:{minute % 60:02d}'
+
+
+def describe_reminder(record):
+    when = 'w dniu wywozu' if record.lead_days == 0 else 'dzień przed wywozem'
+    return f'{format_minute(record.remind_at)}, {when}'
+
+
+def reminder_keyboard(record):
+    """Preset reminder times and lead time, the current choice marked."""
+    def button(label, data, selected):
+        return InlineKeyboardButton(f'✅ {label}' if selected else label, callback_data=data)
     
-    return ConversationHandler.END
+    times = [
+        button(label, f'time:{minute}', minute == record.remind_at)
+        for label, minute in ((t, int(t[:2]) * 60 + int(t[3:])) for t in REMINDER_TIME_CHOICES)
+    ]
+    return InlineKeyboardMarkup([
+        times[:5],
+        times[5:],
+        [button('Dzień wcześniej', 'lead:1', record.lead_days == 1),
+         button('W dniu wywozu', 'lead:0', record.lead_days == 0)]
+    ])
+
+
+def _expect_typed_rejon(update, context, municipality_id=None):
+    """Accept a typed rejon name from this user until they pick one or /cancel."""
+    if municipality_id is None:
+        settings = get_user_settings(update.effective_user.id)
+        municipality_id = settings.municipality if settings else DEFAULT_MUNICIPALITY
+    context.user_data['choosing_rejon'] = municipality_id
+
+
+@track_handler('start')
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Ask for municipality/rejon selection with an inline keyboard."""
+    _expect_typed_rejon(update, context)
+    await update.message.reply_text(
+        '👋 Witaj w Bocie Powiadomień o Wywozie Śmieci!\n\n' + START_PROMPT,
+        reply_markup=START_KEYBOARD
+    )
+
+
+@track_handler('gmina_selected')
+async def municipality_selected(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Show the rejony of the chosen municipality."""
+    municipality = SOURCES.get(update.callback_query.data.split(':', 1)[1])
+    if municipality is None:
+        await _edit_or_reply(update, START_PROMPT, START_KEYBOARD)
+        return
+    _expect_typed_rejon(update, context, municipality.id)
+    await _edit_or_reply(update, f'{municipality.name} - wybierz swój REJON:', REJON_KEYBOARDS[municipality.id])
 
 
-def get_all_upcoming_pickups(rejon: str, days_ahead: int = 90):
-    """Get all upcoming trash pickups for a given rejon within specified days from Google Calendar."""
-    calendar_events = load_schedule_from_calendar(rejon)
+@track_handler('rejon_selected')
+async def rejon_selected(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handle rejon selection (inline button or typed name) with one reply.
     
-    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
-    end_date = today + timedelta(days=days_ahead)
+    A button press edits the keyboard message into the summary, so signing
+    up costs one edit instead of four or five separate messages.
+    """
+    query = update.callback_query
+    if query:
+        # rejon:<municipality>:<rejon>
+        _, municipality_id, rejon = query.data.split(':', 2)
+    else:
+        # Typed names only count right after /start or /zmien, so a stray
+        # "I" or "X" doesn't subscribe anyone or undo /stop
+        municipality_id = context.user_data.get('choosing_rejon')
+        if municipality_id is None:
+            return
+        rejon = update.message.text.strip()
+    source = (municipality_id, rejon)
     
-    all_pickups = []
+    if source_url(source) is None:
+        await _edit_or_reply(update, '❌ Nieprawidłowy rejon.', REJON_KEYBOARDS.get(municipality_id, START_KEYBOARD))
+        return
     
-    for event in calendar_events:
-        event_date = event['date']
-        if isinstance(event_date, str):
-            event_date = datetime.strptime(event_date, '%Y-%m-%d').date()
-        
-        pickup_datetime = datetime.combine(event_date, datetime.min.time())
-        
-        if today <= pickup_datetime <= end_date:
-            days_left = (pickup_datetime - today).days
-            trash_type = event['type']
-            
-            all_pickups.append({
-                'date': pickup_datetime,
-                'type': trash_type,
-                'type_emoji': TRASH_TYPES.get(trash_type.upper(), trash_type).split()[0] if trash_type.upper() in TRASH_TYPES else '🗑️',
-                'days_left': days_left,
-                'day_name': pickup_datetime.strftime('%A')
-            })
+    # Save user settings with subscription enabled
+    save_user_settings(update.effective_user.id, {
+        'municipality': municipality_id,
+        'rejon': rejon,
+        'subscribed': True,
+        'chat_id': update.effective_chat.id
+    })
+    context.user_data.pop('choosing_rejon', None)
+    
+    record = get_user_settings(update.effective_user.id)
+    summary = await render_reply(source, 'wybor')
+    await _edit_or_reply(update, f'{summary}\n\n{selection_footer(record)}', SUBSCRIBED_KEYBOARD)
     
-    return sorted(all_pickups, key=lambda x: x['date'])
+    # The summary includes tomorrow's reminder, don't send it again tonight.
+    # Same-day reminders still go out tomorrow morning.
+    if record.lead_days != 1:
+        return
+    tomorrow = date.today() + timedelta(days=1)
+    try:
+        tomorrow_pickups = await get_pickups_on(source, tomorrow)
+    except CalendarUnavailable:
+        return
+    if tomorrow_pickups:
+        delivery_ledger.mark_sent(update.effective_chat.id, tomorrow.toordinal(), [p['type'] for p in tomorrow_pickups])
 
 
-def get_next_pickup(rejon: str):
-    """Get the next trash pickup for a given rejon (excluding today)."""
-    all_pickups = get_all_upcoming_pickups(rejon, days_ahead=90)
-    # Filter out today's pickups, only show future ones
-    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
-    future_pickups = [p for p in all_pickups if p['date'] > today]
-    return future_pickups[0] if future_pickups else None
+async def get_all_upcoming_pickups(source: tuple, days_ahead: int = 90):
+    """Get all upcoming trash pickups for a given source within specified days from Google Calendar."""
+    index = await get_pickup_index(source)
+    today = date.today().toordinal()
+    return [index.pickup(pos, today) for pos in index.window(today, today + days_ahead)]
+
+
+async def get_pickups_on(source: tuple, day: date):
+    """Get the trash pickups for a given source on a specific day."""
+    index = await get_pickup_index(source)
+    today = date.today().toordinal()
+    return [index.pickup(pos, today) for pos in index.on(day.toordinal())]
+
+
+async def get_next_pickup(source: tuple, days_ahead: int = 90):
+    """Get the next trash pickup for a given source (excluding today)."""
+    index = await get_pickup_index(source)
+    today = date.today().toordinal()
+    pos = index.next_after(today)
+    if pos is None or index.days[pos] > today + days_ahead:
+        return None
+    return index.pickup(pos, today)
+
+
+def render_reminder(pickups):
+    """Render one reminder message covering all pickups of the same day."""
+    first = pickups[0]
+    when = 'Dziś' if first['days_left'] == 0 else 'Jutro'
+    lines = '\n'.join(
+        f'{pickup["type_emoji"]} {pickup["type_name"]}'
+        for pickup in pickups
+    )
+    return (
+        f'🔔 PRZYPOMNIENIE O WYWOZIE ŚMIECI 🔔\n\n'
+        f'{when}, {first["date"].strftime("%d.%m.%Y")} ({first["day_name"]})\n'
+        f'będzie wywóz:\n\n'
+        f'{lines}\n\n'
+        f'Pamiętaj aby wystawić odpady! 🗑️'
+    )
 
 
+@track_handler('harmonogram')
 async def show_schedule(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Show the trash collection schedule for user's rejon from Google Calendar."""
-    user_id = update.effective_user.id
+    """Show the trash collection schedule for user's rejon from Google Calendar.
     
-    if user_id not in user_settings:
-        await update.message.reply_text('⚠️ Najpierw wybierz swój rejon używając /start')
-        return
+    /harmonogram sends the first page; the page buttons edit that message.
+    """
+    user_id = update.effective_user.id
     
-    rejon = user_settings[user_id]['rejon']
-    upcoming_pickups = get_all_upcoming_pickups(rejon, days_ahead=180)
+    settings = get_user_settings(user_id)
     
-    if not upcoming_pickups:
-        await update.message.reply_text(f'📅 Brak zaplanowanych wywozów dla REJON {rejon}')
+    if settings is None:
+        await _edit_or_reply(update, '⚠️ Najpierw wybierz swój rejon używając /start')
         return
     
-    message = f'📅 Harmonogram wywozu śmieci - REJON {rejon}\n\n'
-    message += 'Najbliższe wywozy:\n\n'
-    
-    for pickup in upcoming_pickups[:15]:  # Show first 15 pickups
-        date_str = pickup['date'].strftime('%d.%m.%Y (%A)')
-        message += f'{pickup["type_emoji"]} {date_str} - {pickup["type"]}\n'
-    
-    if len(upcoming_pickups) > 15:
-        message += f'\n... i więcej ({len(upcoming_pickups)} wywozów w sumie)'
-    
-    await update.message.reply_text(message)
+    source = settings.source
+    try:
+        pages = await render_reply(source, 'harmonogram')
+    except CalendarUnavailable:
+        await _edit_or_reply(update, CALENDAR_UNAVAILABLE_TEXT)
+        return
+    query = update.callback_query
+    page = min(int(query.data.split(':', 1)[1]), len(pages) - 1) if query else 0
+    await _edit_or_reply(update, pages[page] + stale_notice(source), schedule_keyboard(page, len(pages)))
 
 
+@track_handler('nastepny')
 async def show_next_pickup(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Show the next trash pickup."""
     user_id = update.effective_user.id
     
-    if user_id not in user_settings:
+    settings = get_user_settings(user_id)
+    
+    if settings is None:
         await update.message.reply_text('⚠️ Najpierw wybierz swój rejon używając /start')
         return
     
-    rejon = user_settings[user_id]['rejon']
-    next_pickup = get_next_pickup(rejon)
+    source = settings.source
+    try:
+        message = await render_reply(source, 'nastepny')
+    except CalendarUnavailable:
+        await update.message.reply_text(CALENDAR_UNAVAILABLE_TEXT)
+        return
     
-    if next_pickup:
-        await update.message.reply_text(
-            f'🔔 Najbliższy wywóz:\n'
-            f'{next_pickup["type_emoji"]} {TRASH_TYPES.get(next_pickup["type"], next_pickup["type"])}\n'
-            f'📅 Data: {next_pickup["date"].strftime("%d.%m.%Y")} ({next_pickup["day_name"]})\n'
-            f'⏰ Za {next_pickup["days_left"]} dni'
-        )
+    if message:
+        await update.message.reply_text(message + stale_notice(source))
     else:
         await update.message.reply_text('Brak zaplanowanych wywozów w najbliższym czasie.')
 
 
-async def change_rejon(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Allow user to change their rejon."""
-    keyboard = [
-        ['I', 'II', 'III'],
-        ['IV', 'V', 'VI'],
-        ['VII', 'VIII', 'IX'],
-        ['X', 'XI', 'XII']
-    ]
-    reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True, resize_keyboard=True)
-    
-    await update.message.reply_text(
-        '🔄 Wybierz nowy REJON:',
-        reply_markup=reply_markup
-    )
-    
-    return REJON_SELECT
+@track_handler('zmien')
+async def change_rejon(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Allow user to change their rejon (or municipality, if there are several)."""
+    _expect_typed_rejon(update, context)
+    if len(SOURCES) > 1:
+        await _edit_or_reply(update, '🔄 Wybierz gminę:', START_KEYBOARD)
+    else:
+        await _edit_or_reply(update, '🔄 Wybierz nowy REJON:', START_KEYBOARD)
 
 
+@track_handler('stop')
 async def stop(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Stop notifications for the user."""
     user_id = update.effective_user.id
     
-    if user_id in user_settings:
-        user_settings[user_id]['subscribed'] = False
-        save_user_settings()
-        await update.message.reply_text('👋 Powiadomienia zostały wyłączone. Użyj /start aby włączyć ponownie.')
+    if get_user_settings(user_id) is not None:
+        unsubscribe_user(user_id)
+        await _edit_or_reply(update, '👋 Powiadomienia zostały wyłączone.', UNSUBSCRIBED_KEYBOARD)
     else:
-        await update.message.reply_text('Powiadomienia nie były włączone.')
+        await _edit_or_reply(update, 'Powiadomienia nie były włączone.')
+
+
+@track_handler('resubscribe')
+async def resubscribe(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Turn notifications back on for the previously chosen rejon."""
+    settings = get_user_settings(update.effective_user.id)
+    
+    if settings is None:
+        _expect_typed_rejon(update, context)
+        await _edit_or_reply(update, START_PROMPT, START_KEYBOARD)
+        return
+    
+    save_user_settings(update.effective_user.id, {
+        'rejon': settings.rejon,
+        'subscribed': True,
+        'chat_id': update.effective_chat.id
+    })
+    await _edit_or_reply(update, f'🔔 Powiadomienia włączone ponownie (REJON {settings.rejon}).', SUBSCRIBED_KEYBOARD)
 
 
+@track_handler('przypomnienie')
+async def reminder_settings(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Show or change when the user gets reminders.
+    
+    `/przypomnienie 7:30` sets any minute directly; the buttons pick a preset
+    time or the lead time and edit the message in place.
+    """
+    user_id = update.effective_user.id
+    settings = get_user_settings(user_id)
+    
+    if settings is None:
+        await _edit_or_reply(update, '⚠️ Najpierw wybierz swój rejon używając /start')
+        return
+    
+    remind_at, lead_days = settings.remind_at, settings.lead_days
+    query = update.callback_query
+    if query and ':' in query.data:
+        kind, value = query.data.split(':', 1)
+        if kind == 'time':
+            remind_at = int(value) % (24 * 60)
+        else:
+            lead_days = int(value)
+    elif not query and context.args:
+        match = re.fullmatch(r'(\d{1,2})[:.](\d{2})', context.args[0])
+        if not match or int(match.group(1)) > 23 or int(match.group(2)) > 59:
+            await update.message.reply_text('❌ Podaj godzinę w formacie GG:MM, np. /przypomnienie 7:30')
+            return
+        remind_at = int(match.group(1)) * 60 + int(match.group(2))
+    
+    if (remind_at, lead_days) != (settings.remind_at, settings.lead_days):
+        save_user_settings(user_id, {
+            'rejon': settings.rejon,
+            'subscribed': settings.subscribed,
+            'chat_id': settings.chat_id,
+            'remind_at': remind_at,
+            'lead_days': lead_days
+        })
+    
+    await _edit_or_reply(
+        update,
+        f'⏰ Przypomnienie: {describe_reminder(settings)}\n\n'
+        'Wybierz godzinę albo wpisz dowolną, np. /przypomnienie 7:30',
+        reminder_keyboard(settings)
+    )
+
+
+@track_handler('help')
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Show help message."""
     user_id = update.effective_user.id
-    is_subscribed = user_id in user_settings and user_settings[user_id].get('subscribed', False)
+    settings = get_user_settings(user_id)
+    is_subscribed = settings is not None and settings.subscribed
+    municipality = SOURCES[settings.municipality if settings else DEFAULT_MUNICIPALITY]
     
     help_text = (
         '🤖 Bot Powiadomień o Wywozie Śmieci\n\n'
@@ -370,19 +1657,17 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         '/start - Rozpocznij i wybierz rejon\n'
         '/harmonogram - Pokaż pełny harmonogram\n'
         '/nastepny - Pokaż najbliższy wywóz\n'
+        '/przypomnienie - Ustaw godzinę przypomnienia\n'
         '/zmien - Zmień rejon\n'
         '/stop - Wyłącz powiadomienia\n'
         '/help - Pokaż tę wiadomość\n\n'
         'Typy śmieci:\n'
-        '🗑️ Zmieszane - odpady niesegregowane\n'
-        '♻️ Segregowane - odpady segregowane\n'
-        '🛋️ Gabaryty - duże przedmioty\n'
-        '🌿 Ogrodowe - odpady ogrodowe\n\n'
     )
+    help_text += ''.join(f'{name}\n' for name in municipality.types.values()) + '\n'
     
     if is_subscribed:
         help_text += '✅ Powiadomienia są włączone\n'
-        help_text += 'Otrzymasz przypomnienie jeden dzień przed wywozem o 9:00 i 18:00'
+        help_text += f'Przypomnienie: {describe_reminder(settings)}'
     else:
         help_text += '❌ Powiadomienia są wyłączone\n'
         help_text += 'Użyj /start aby włączyć powiadomienia'
@@ -390,12 +1675,14 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     await update.message.reply_text(help_text)
 
 
-async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Cancel the conversation."""
+@track_handler('cancel')
+async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Stop waiting for a typed rejon name after /start or /zmien."""
+    context.user_data.pop('choosing_rejon', None)
     await update.message.reply_text('Anulowano. Użyj /start aby rozpocząć ponownie.')
-    return ConversationHandler.END
 
 
+@track_handler('test')
 async def test_notification(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Manually trigger notification check (for testing)."""
     await update.message.reply_text('🔍 Sprawdzam powiadomienia...')
@@ -403,53 +1690,883 @@ async def test_notification(update: Update, context: ContextTypes.DEFAULT_TYPE)
     await update.message.reply_text('✅ Sprawdzanie zakończone')
 
 
-async def check_and_send_notifications(context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Check for upcoming pickups and send notifications (optimized for scale)."""
-    logger.info('Checking for notifications to send...')
+class TokenBucket:
+    """Async token bucket: `rate` tokens per second, bursts up to `capacity`."""
     
-    tomorrow = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
     
-    # Group users by rejon to fetch each calendar only once
-    users_by_rejon = {}
-    for user_id, settings in user_settings.items():
-        if not settings.get('subscribed', False):
-            continue
+    def pause(self, seconds):
+        """Stop handing out tokens for a while (after Telegram asked us to back off)."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+    
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class DeliveryLedger:
+    """Which reminders were delivered, keyed by (chat_id, pickup day, trash type).
+    
+    Kept in memory as per-day sets and persisted as an append-only log of
+    tab-separated lines: `S day chat_id type` for a delivered reminder and
+    `F day chat_id` for a failed attempt. The type is written as a JSON string,
+    since calendar summaries may contain tabs or newlines. Days in the past are
+    pruned, which also rewrites the log so it never grows beyond the upcoming
+    days.
+    """
+    
+    def __init__(self, path=DELIVERY_LEDGER_FILE):
+        self.path = path
+        self.sent = {}  # day ordinal -> {(chat_id, type)}
+        self.failed = {}  # day ordinal -> {chat_id}
+        self._file = None
+    
+    def load(self):
+        """Load the ledger from disk and drop entries for past days."""
+        self.sent, self.failed = {}, {}
+        bad_lines = 0
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        try:
+                            kind, day, chat_id, *rest = line.rstrip('\n').split('\t', 3)
+                            day, chat_id = int(day), int(chat_id)
+                            if kind == 'S':
+                                trash_type = json.loads(rest[0])
+                                self.sent.setdefault(day, set()).add((chat_id, trash_type))
+                                self.failed.get(day, set()).discard(chat_id)
+                            elif kind == 'F':
+                                self.failed.setdefault(day, set()).add(chat_id)
+                            else:
+                                raise ValueError(kind)
+                        except (ValueError, IndexError):
+                            # e.g. a torn last line after a crash; keep everything else
+                            bad_lines += 1
+        except Exception as e:
+            logger.error(f'Error loading delivery ledger: {e}')
+        if bad_lines:
+            logger.warning(f'Skipped {bad_lines} unreadable lines in {self.path}')
+        self.prune(date.today().toordinal(), force=True)
+    
+    def is_sent(self, chat_id, day, trash_type):
+        return (chat_id, trash_type) in self.sent.get(day, ())
+    
+    def failed_chats(self, day):
+        return self.failed.get(day, set())
+    
+    def mark_sent(self, chat_id, day, types):
+        sent = self.sent.setdefault(day, set())
+        for trash_type in types:
+            sent.add((chat_id, trash_type))
+            self._append(f'S\t{day}\t{chat_id}\t{json.dumps(trash_type, ensure_ascii=False)}\n')
+        self.failed.get(day, set()).discard(chat_id)
+    
+    def mark_failed(self, chat_id, day):
+        self.failed.setdefault(day, set()).add(chat_id)
+        self._append(f'F\t{day}\t{chat_id}\n')
+    
+    def prune(self, today, force=False):
+        """Forget days before `today`; rewrites the log if anything was dropped."""
+        past = [day for day in set(self.sent) | set(self.failed) if day < today]
+        for day in past:
+            self.sent.pop(day, None)
+            self.failed.pop(day, None)
+        if past or force:
+            self._rewrite()
+    
+    def _append(self, line):
+        if self._file is None:
+            self._file = open(self.path, 'a', encoding='utf-8')
+        self._file.write(line)
+        self._file.flush()
+    
+    def _rewrite(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        try:
+            temp_file = self.path + '.tmp'
+            with open(temp_file, 'w', encoding='utf-8') as f:
+                for day, entries in self.sent.items():
+                    for chat_id, trash_type in entries:
+                        f.write(f'S\t{day}\t{chat_id}\t{json.dumps(trash_type, ensure_ascii=False)}\n')
+                for day, chat_ids in self.failed.items():
+                    for chat_id in chat_ids:
+                        f.write(f'F\t{day}\t{chat_id}\n')
+            os.replace(temp_file, self.path)
+        except Exception as e:
+            logger.error(f'Error compacting delivery ledger: {e}')
+
+
+delivery_ledger = DeliveryLedger()
+
+
+class Outbox:
+    """Reminders queued for the sharded workers, plus leases, in one SQLite file.
+    
+    Every call opens its own short-lived connection, so the methods can run in
+    worker threads (asyncio.to_thread) and in separate processes. A row moves
+    pending -> sending (claimed by its shard's worker) -> sent/failed/unreachable,
+    and is deleted once the leader has recorded the result in its delivery
+    ledger. Rendered texts are stored once and shared by all their rows.
+    """
+    
+    def __init__(self, path=NOTIFIER_DB):
+        self.path = path
+        with closing(self._connect()) as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(
+                'CREATE TABLE IF NOT EXISTS leases ('
+                'name TEXT PRIMARY KEY, holder TEXT NOT NULL, expires_at REAL NOT NULL);'
+                'CREATE TABLE IF NOT EXISTS texts (id INTEGER PRIMARY KEY, body TEXT NOT NULL UNIQUE);'
+                'CREATE TABLE IF NOT EXISTS outbox ('
+                'id INTEGER PRIMARY KEY, shard INTEGER NOT NULL, chat_id INTEGER NOT NULL, '
+                'day INTEGER NOT NULL, types TEXT NOT NULL, text_id INTEGER NOT NULL, '
+                "status TEXT NOT NULL DEFAULT 'pending', UNIQUE (chat_id, day));"
+                'CREATE INDEX IF NOT EXISTS outbox_shard_status ON outbox (shard, status);'
+            )
+    
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+    
+    def acquire_lease(self, name, holder, ttl):
+        """Take or renew lease `name` for `ttl` seconds; False if someone else holds it."""
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                'INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?) '
+                'ON CONFLICT (name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at '
+                'WHERE leases.holder = excluded.holder OR leases.expires_at < ?',
+                (name, holder, now + ttl, now)
+            )
+            row = conn.execute('SELECT holder FROM leases WHERE name = ?', (name,)).fetchone()
+        return row is not None and row[0] == holder
+    
+    def release_lease(self, name, holder):
+        with closing(self._connect()) as conn, conn:
+            conn.execute('DELETE FROM leases WHERE name = ? AND holder = ?', (name, holder))
+    
+    def enqueue(self, items, shards):
+        """Queue (chat_id, day, types, text) reminders; returns how many were new.
         
-        rejon = settings.get('rejon')
-        chat_id = settings.get('chat_id')
+        A chat that still has a reminder for that day in the queue is skipped.
+        """
+        text_ids = {}
+        with closing(self._connect()) as conn, conn:
+            for _, _, _, text in items:
+                if text not in text_ids:
+                    conn.execute('INSERT OR IGNORE INTO texts (body) VALUES (?)', (text,))
+                    text_ids[text] = conn.execute('SELECT id FROM texts WHERE body = ?', (text,)).fetchone()[0]
+            before = conn.total_changes
+            conn.executemany(
+                'INSERT OR IGNORE INTO outbox (shard, chat_id, day, types, text_id) VALUES (?, ?, ?, ?, ?)',
+                ((chat_id % shards, chat_id, day, json.dumps(types), text_ids[text])
+                 for chat_id, day, types, text in items)
+            )
+            return conn.total_changes - before
+    
+    def requeue(self, shard):
+        """Return rows a previous run of this shard's worker left half-sent."""
+        with closing(self._connect()) as conn, conn:
+            conn.execute("UPDATE outbox SET status = 'pending' WHERE shard = ? AND status = 'sending'", (shard,))
+    
+    def claim(self, shard, limit=NOTIFIER_BATCH):
+        """Mark up to `limit` pending rows of a shard as sending; returns (id, chat_id, text)."""
+        with closing(self._connect()) as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            rows = conn.execute(
+                'SELECT outbox.id, outbox.chat_id, texts.body FROM outbox JOIN texts ON texts.id = outbox.text_id '
+                "WHERE outbox.shard = ? AND outbox.status = 'pending' ORDER BY outbox.id LIMIT ?",
+                (shard, limit)
+            ).fetchall()
+            conn.executemany("UPDATE outbox SET status = 'sending' WHERE id = ?", ((row[0],) for row in rows))
+            conn.commit()
+        return rows
+    
+    def complete(self, results):
+        """Store (status, id) results reported by a worker."""
+        with closing(self._connect()) as conn, conn:
+            conn.executemany('UPDATE outbox SET status = ? WHERE id = ?', results)
+    
+    def collect(self):
+        """Remove finished rows and return them with the number still queued.
         
-        if not rejon or not chat_id:
-            continue
+        Returns ([(chat_id, day, types, status), ...], backlog).
+        """
+        with closing(self._connect()) as conn, conn:
+            rows = conn.execute(
+                "SELECT id, chat_id, day, types, status FROM outbox WHERE status NOT IN ('pending', 'sending')"
+            ).fetchall()
+            conn.executemany('DELETE FROM outbox WHERE id = ?', ((row[0],) for row in rows))
+            if rows:
+                conn.execute('DELETE FROM texts WHERE id NOT IN (SELECT text_id FROM outbox)')
+            backlog = conn.execute('SELECT COUNT(*) FROM outbox').fetchone()[0]
+        return [(chat_id, day, json.loads(types), status) for _, chat_id, day, types, status in rows], backlog
+
+
+def is_leader():
+    """Take or renew the notifier lease; only the holder schedules sweeps."""
+    return outbox.acquire_lease('notifier', INSTANCE_ID, NOTIFIER_LEASE_TTL)
+
+
+class Broadcaster:
+    """Send many messages with bounded concurrency and Telegram rate limits.
+    
+    `bot` only needs an async `send_message(chat_id=..., text=...)`, so a fake
+    object can stand in for tests. Messages to one chat are sent in order and
+    spaced by `per_chat_interval`; chats Telegram reports as unreachable
+    (blocked the bot, deleted, not found) are passed to `on_unreachable`.
+    """
+    
+    def __init__(self, bot, rate=BROADCAST_RATE, concurrency=BROADCAST_CONCURRENCY,
+                 per_chat_interval=BROADCAST_PER_CHAT_INTERVAL, max_retries=BROADCAST_MAX_RETRIES,
+                 on_sent=None, on_failed=None, on_unreachable=None):
+        self.bot = bot
+        self.bucket = TokenBucket(rate)
+        self.concurrency = concurrency
+        self.per_chat_interval = per_chat_interval
+        self.max_retries = max_retries
+        self.on_sent = on_sent
+        self.on_failed = on_failed
+        self.on_unreachable = on_unreachable
+        self.stats = {'sent': 0, 'failed': 0, 'retry_after': 0, 'unreachable': 0}
+    
+    async def _send(self, chat_id, text):
+        """Send one message, retrying on flood control and network errors.
+        
+        Returns 'sent', 'failed' or 'unreachable'.
+        """
+        for attempt in range(self.max_retries + 1):
+            await self.bucket.acquire()
+            try:
+                await self.bot.send_message(chat_id=chat_id, text=text)
+                return 'sent'
+            except RetryAfter as e:
+                self.stats['retry_after'] += 1
+                metrics.inc('telegram_retry_after_total')
+                retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+                logger.warning(f'Flood control hit, pausing broadcast for {retry_after}s')
+                self.bucket.pause(retry_after)
+            except Forbidden as e:
+                logger.info(f'Chat {chat_id} is unreachable: {e}')
+                return 'unreachable'
+            except BadRequest as e:
+                if 'chat not found' in str(e).lower():
+                    logger.info(f'Chat {chat_id} is unreachable: {e}')
+                    return 'unreachable'
+                logger.error(f'Error sending message to chat {chat_id}: {e}')
+                return 'failed'
+            except NetworkError as e:
+                logger.warning(f'Network error sending to chat {chat_id} (attempt {attempt + 1}): {e}')
+                await asyncio.sleep(2 ** attempt)
+            except Exception as e:
+                logger.error(f'Error sending message to chat {chat_id}: {e}')
+                return 'failed'
+        logger.error(f'Giving up on chat {chat_id} after {self.max_retries + 1} attempts')
+        return 'failed'
+    
+    async def _send_chat(self, chat_id, texts):
+        for i, text in enumerate(texts):
+            if i:
+                await asyncio.sleep(self.per_chat_interval)
+            result = await self._send(chat_id, text)
+            metrics.inc('messages_total', result=result)
+            if result == 'sent':
+                self.stats['sent'] += 1
+                logger.debug(f'Sent notification to chat {chat_id}')
+                if self.stats['sent'] % BROADCAST_LOG_EVERY == 0:
+                    logger.info(f'Broadcast progress: {self.stats["sent"]} messages sent')
+                continue
+            self.stats['failed'] += len(texts) - i
+            if result == 'unreachable':
+                self.stats['unreachable'] += 1
+                if self.on_unreachable:
+                    self.on_unreachable(chat_id)
+            elif self.on_failed:
+                self.on_failed(chat_id)
+            return
+        if self.on_sent:
+            self.on_sent(chat_id)
+    
+    async def send_all(self, messages):
+        """Send (chat_id, text) pairs and return the broadcast stats."""
+        by_chat = {}
+        for chat_id, text in messages:
+            by_chat.setdefault(chat_id, []).append(text)
+        
+        started = time.monotonic()
+        queue = asyncio.Queue()
+        for item in by_chat.items():
+            queue.put_nowait(item)
+        
+        async def worker():
+            while not queue.empty():
+                chat_id, texts = queue.get_nowait()
+                await self._send_chat(chat_id, texts)
         
-        if rejon not in users_by_rejon:
-            users_by_rejon[rejon] = []
-        users_by_rejon[rejon].append({'user_id': user_id, 'chat_id': chat_id})
-    
-    # Process each rejon once
-    for rejon, users in users_by_rejon.items():
-        # Fetch calendar once for all users in this rejon
-        all_pickups = get_all_upcoming_pickups(rejon, days_ahead=2)
-        tomorrow_pickups = [p for p in all_pickups if p['date'].date() == tomorrow.date()]
+        await asyncio.gather(*(worker() for _ in range(min(self.concurrency, len(by_chat)))))
         
-        if not tomorrow_pickups:
+        duration = time.monotonic() - started
+        self.stats['chats'] = len(by_chat)
+        self.stats['duration'] = round(duration, 3)
+        self.stats['throughput'] = round(self.stats['sent'] / duration, 2) if duration > 0 else 0.0
+        return self.stats
+
+
+async def send_reminders(bot, minutes=None, retry_only=False, today=None):
+    """Send the reminders of the given reminder minutes (optimized for scale).
+    
+    `minutes=None` means every slot whose time has already passed today
+    (catch-up after a restart). Reminders already recorded in the delivery
+    ledger are skipped, so repeated runs only send what is still missing;
+    with `retry_only` only chats whose delivery failed are tried again.
+    """
+    today = today or date.today()
+    if minutes is None:
+        now = datetime.now()
+        minutes = [minute for minute in subscribers.by_slot if minute <= now.hour * 60 + now.minute]
+    delivery_ledger.prune(today.toordinal())
+    if retry_only and not any(delivery_ledger.failed.values()):
+        return
+    
+    # Which (source, lead_days) groups are due, and their pickup days
+    groups = {}
+    for minute in minutes:
+        for (source, lead_days), chat_ids in subscribers.slot(minute).items():
+            if source_url(source) is not None and chat_ids:
+                groups.setdefault((source, lead_days), []).append(chat_ids)
+    
+    # Fetch each source/day's pickups concurrently, once for all its users
+    keys = sorted({(source, today + timedelta(days=lead_days)) for source, lead_days in groups})
+    results = await asyncio.gather(*(get_pickups_on(source, day) for source, day in keys), return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception) and not isinstance(result, CalendarUnavailable):
+            raise result
+    pickups_on = dict(zip(keys, results))
+    
+    # One combined reminder per chat. The text only depends on the source, the
+    # day and the pickups still missing, so it is rendered once per such
+    # combination and shared by all subscribers
+    messages = {}
+    pending = {}
+    rendered = {}
+    unavailable = set()
+    for (source, lead_days), slots in groups.items():
+        pickup_day = today + timedelta(days=lead_days)
+        day_pickups = pickups_on[(source, pickup_day)]
+        day = pickup_day.toordinal()
+        if isinstance(day_pickups, CalendarUnavailable):
+            # Nothing known about this source: mark its chats failed, so the
+            # hourly retry reminds them once the calendar loads
+            unavailable.add(source)
+            if not retry_only:
+                for chat_ids in slots:
+                    for chat_id in chat_ids:
+                        delivery_ledger.mark_failed(chat_id, day)
+            continue
+        if not day_pickups:
             continue
+        retry_chats = delivery_ledger.failed_chats(day) if retry_only else None
         
-        # Send notifications to all users in this rejon
-        for user in users:
-            for pickup in tomorrow_pickups:
-                message = (
-                    f'🔔 PRZYPOMNIENIE O WYWOZIE ŚMIECI 🔔\n\n'
-                    f'Jutro, {pickup["date"].strftime("%d.%m.%Y")} ({pickup["day_name"]})\n'
-                    f'będzie wywóz:\n\n'
-                    f'{pickup["type_emoji"]} {TRASH_TYPES.get(pickup["type"], pickup["type"])}\n\n'
-                    f'Pamiętaj aby wystawić odpady! 🗑️'
-                )
+        for chat_ids in slots:
+            for chat_id in chat_ids:
+                if chat_id in messages or (retry_only and chat_id not in retry_chats):
+                    continue
+                missing = [p for p in day_pickups if not delivery_ledger.is_sent(chat_id, day, p['type'])]
+                if not missing:
+                    continue
                 
+                types = tuple(p['type'] for p in missing)
+                key = (source, day, types)
+                if key not in rendered:
+                    rendered[key] = render_reminder(missing)
+                messages[chat_id] = rendered[key]
+                pending[chat_id] = (day, types)
+    
+    if unavailable:
+        logger.warning(f'No calendar for {len(unavailable)} sources, their reminders wait for the hourly retry')
+    if not messages:
+        return
+    
+    sweep_kind = 'retry' if retry_only else 'full'
+    if NOTIFIER_WORKERS:
+        # Workers send; results come back through collect_deliveries
+        items = [(chat_id, *pending[chat_id], text) for chat_id, text in messages.items()]
+        queued = await asyncio.to_thread(outbox.enqueue, items, NOTIFIER_WORKERS)
+        metrics.inc('sweeps_total', kind=sweep_kind)
+        logger.info(f'Queued {queued} reminders for {NOTIFIER_WORKERS} notifier workers')
+        return
+    
+    sweep_started = time.perf_counter()
+    unreachable = []
+    broadcaster = Broadcaster(
+        bot,
+        on_sent=lambda chat_id: delivery_ledger.mark_sent(chat_id, *pending[chat_id]),
+        on_failed=lambda chat_id: delivery_ledger.mark_failed(chat_id, pending[chat_id][0]),
+        on_unreachable=unreachable.append
+    )
+    stats = await broadcaster.send_all(messages.items())
+    
+    # Unsubscribe chats that blocked the bot or no longer exist
+    if unreachable:
+        subscribers.unsubscribe_chats(unreachable)
+        settings_store.unsubscribe_chats(unreachable)
+    
+    metrics.observe('sweep_seconds', time.perf_counter() - sweep_started, kind=sweep_kind)
+    metrics.inc('sweeps_total', kind=sweep_kind)
+    logger.info(f'Notification broadcast finished: {stats}')
+
+
+async def check_and_send_notifications(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Job callback around send_reminders, run only by the notifier lease holder.
+    
+    Job data may hold 'minutes' (the reminder slots to sweep; default: all
+    slots already due today) and 'retry_only'.
+    """
+    job_data = (context.job.data if context.job else None) or {}
+    retry_only = bool(job_data.get('retry_only'))
+    if not await asyncio.to_thread(is_leader):
+        logger.info('Another instance holds the notifier lease, skipping notification check')
+        return
+    logger.info('Retrying failed notifications...' if retry_only else 'Checking for notifications to send...')
+    await send_reminders(context.bot, job_data.get('minutes'), retry_only)
+
+
+def _slot_timestamp(minute, day):
+    return datetime.combine(day, datetime.min.time()).timestamp() + minute * 60
+
+
+class ReminderScheduler:
+    """Fires reminder sweeps at the minutes subscribers chose, with one timer.
+    
+    Upcoming slots are kept in a min-heap of (timestamp, minute) and a single
+    JobQueue job is armed for the earliest one, so there are no per-user jobs
+    and load follows the users' choices instead of one global instant.
+    Calendars are refreshed SWEEP_REFRESH_LEAD seconds before the armed
+    slot, unless the previous such refresh is more recent than that.
+    Adding a slot is a heappush, re-arming the timer only if it became the
+    earliest. Slots whose last subscriber left are dropped lazily when they
+    come up, and each fired slot is pushed again for the next day.
+    """
+    
+    def __init__(self):
+        self.heap = []  # (timestamp, minute)
+        self.queued = set()  # minutes currently in the heap
+        self.job_queue = None
+        self.job = None
+        self.armed_at = None
+        self.refresh_job = None
+        self.refresh_at = None
+        self.refreshed_at = 0.0
+    
+    def start(self, job_queue):
+        self.job_queue = job_queue
+        self.heap, self.queued = [], set()
+        for minute in subscribers.by_slot:
+            self._push(minute)
+        self._arm()
+    
+    def add(self, minute):
+        if minute in self.queued:
+            return
+        at = self._push(minute)
+        if self.job_queue is not None and (self.armed_at is None or at < self.armed_at):
+            self._arm()
+    
+    def _push(self, minute, after=None):
+        after = after or time.time()
+        day = date.today()
+        at = _slot_timestamp(minute, day)
+        while at <= after:
+            day += timedelta(days=1)
+            at = _slot_timestamp(minute, day)
+        heapq.heappush(self.heap, (at, minute))
+        self.queued.add(minute)
+        return at
+    
+    def _arm(self):
+        if self.job is not None:
+            self.job.schedule_removal()
+            self.job, self.armed_at = None, None
+        if self.heap:
+            self.armed_at = self.heap[0][0]
+            self.job = self.job_queue.run_once(
+                self._fire, when=max(0.0, self.armed_at - time.time()), name='reminder_slots'
+            )
+            self._arm_refresh()
+    
+    def _arm_refresh(self):
+        at = self.armed_at - SWEEP_REFRESH_LEAD
+        # Too late for this slot, or the last pre-sweep refresh is recent enough
+        if at <= time.time() or at - self.refreshed_at < SWEEP_REFRESH_LEAD:
+            return
+        if self.refresh_job is not None:
+            if self.refresh_at <= at:
+                return
+            self.refresh_job.schedule_removal()
+        self.refresh_at = at
+        self.refresh_job = self.job_queue.run_once(self._refresh, when=at - time.time(), name='sweep_refresh')
+    
+    async def _refresh(self, context: ContextTypes.DEFAULT_TYPE) -> None:
+        self.refresh_job, self.refresh_at = None, None
+        self.refreshed_at = time.time()
+        await refresh_calendars(context)
+    
+    async def _fire(self, context: ContextTypes.DEFAULT_TYPE) -> None:
+        self.job, self.armed_at = None, None
+        due = []
+        day = None
+        while self.heap and self.heap[0][0] <= time.time() + 1:
+            at, minute = heapq.heappop(self.heap)
+            self.queued.discard(minute)
+            if subscribers.slot(minute):
+                due.append(minute)
+                day = day or date.fromtimestamp(at)
+                self._push(minute, after=at)
+        self._arm()
+        metrics.set('reminder_slots', len(self.queued))
+        if not due or not await asyncio.to_thread(is_leader):
+            return
+        logger.info(f'Sending reminders for {len(due)} slot(s) starting {due[0] // 60:02d}:{due[0] % 60:02d}')
+        await send_reminders(context.bot, due, today=day)
+
+
+reminder_scheduler = ReminderScheduler()
+
+
+async def renew_leadership(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Keep the notifier lease; an instance that just took it over runs a catch-up check.
+    
+    An instance taking over from another one (rather than at startup) first
+    reloads the subscribers and the delivery ledger, which the previous
+    leader kept changing while this one was waiting.
+    """
+    leader = await asyncio.to_thread(is_leader)
+    if leader and context.bot_data.get('leader') is False:
+        subscribers.load(settings_store.iter_users())
+        delivery_ledger.load()
+        reminder_scheduler.start(context.job_queue)
+        logger.info(f'Took over the notifier lease, reloaded {len(subscribers)} users')
+    if leader and not context.bot_data.get('leader'):
+        logger.info('Holding the notifier lease, running notification check in 5 seconds...')
+        context.job_queue.run_once(check_and_send_notifications, when=5)
+    context.bot_data['leader'] = leader
+    metrics.set('notifier_leader', int(leader))
+
+
+async def collect_deliveries(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Record results reported by the notifier workers (leader only).
+    
+    The ledger and the subscriber registry keep a single writer: workers only
+    update their queue rows and the leader applies the outcome here.
+    """
+    if not context.bot_data.get('leader'):
+        return
+    done, backlog = await asyncio.to_thread(outbox.collect)
+    unreachable = []
+    for chat_id, day, types, status in done:
+        metrics.inc('messages_total', result=status)
+        if status == 'sent':
+            delivery_ledger.mark_sent(chat_id, day, types)
+        elif status == 'failed':
+            delivery_ledger.mark_failed(chat_id, day)
+        else:
+            unreachable.append(chat_id)
+    if unreachable:
+        subscribers.unsubscribe_chats(unreachable)
+        settings_store.unsubscribe_chats(unreachable)
+    metrics.set('outbox_backlog', backlog)
+    if done:
+        logger.info(f'Collected {len(done)} delivery results from workers, {backlog} still queued')
+
+
+def _update_gauges():
+    """Refresh gauges that are derived from current state rather than events."""
+    metrics.set('users', len(subscribers))
+    metrics.set('subscribers', sum(len(chat_ids) for chat_ids in subscribers.by_source.values()))
+    for source in _calendar_cache:
+        metrics.set('calendar_age_seconds', round(calendar_age(source), 1), **source_labels(source))
+    # Circuit state per source: 0 closed (healthy), 1 half-open (probing), 2 open (failing)
+    for source in all_sources():
+        metrics.set('calendar_circuit_state', CIRCUIT_STATES.index(circuit_state(source)), **source_labels(source))
+
+
+async def monitor_event_loop(interval=1.0):
+    """Record how late the event loop wakes up a task (runs until cancelled)."""
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        lag = max(0.0, time.perf_counter() - started - interval)
+        metrics.set('event_loop_lag_seconds', round(lag, 6))
+        metrics.observe('event_loop_lag', lag)
+
+
+async def _read_http_request(reader):
+    """Read one HTTP/1.1 request as (method, path, headers, body), or None if malformed."""
+    request_line = await reader.readline()
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if not line.strip():
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    
+    parts = request_line.decode('latin-1').split()
+    if len(parts) < 2:
+        return None
+    length = headers.get('content-length') or '0'
+    # Non-numeric or negative lengths are malformed (answered with 400)
+    if not (length.isascii() and length.isdigit()) or int(length) > HTTP_MAX_BODY:
+        return None
+    length = int(length)
+    body = await reader.readexactly(length) if length else b''
+    return parts[0], parts[1].split('?')[0], headers, body
+
+
+async def _write_http_response(writer, status, body=b'', content_type='text/plain; charset=utf-8'):
+    writer.write(
+        f'HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n'
+        f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body
+    )
+    await writer.drain()
+
+
+async def _serve_metrics(reader, writer):
+    """Minimal HTTP/1.1 responder for GET /metrics."""
+    try:
+        request = await asyncio.wait_for(_read_http_request(reader), HTTP_READ_TIMEOUT)
+        if request and request[0] == 'GET' and request[1] == '/metrics':
+            _update_gauges()
+            await _write_http_response(writer, '200 OK', metrics.render().encode(), 'text/plain; version=0.0.4')
+        else:
+            await _write_http_response(writer, '404 Not Found', b'not found\n')
+    except Exception as e:
+        logger.debug(f'Metrics request failed: {e}')
+    finally:
+        writer.close()
+
+
+def _write_metrics_file(data):
+    """Write the stats file atomically (runs in a worker thread)."""
+    try:
+        temp_file = METRICS_FILE + '.tmp'
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=2, ensure_ascii=False)
+        os.replace(temp_file, METRICS_FILE)
+    except Exception as e:
+        logger.error(f'Error writing metrics file: {e}')
+
+
+async def write_metrics_file(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Dump all metrics to METRICS_FILE (JobQueue callback)."""
+    _update_gauges()
+    data = {'timestamp': datetime.now().isoformat(timespec='seconds'), 'metrics': metrics.snapshot()}
+    await asyncio.to_thread(_write_metrics_file, data)
+
+
+@track_handler('stats')
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Show bot statistics (admins only)."""
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text('⛔ Ta komenda jest dostępna tylko dla administratorów.')
+        return
+    
+    _update_gauges()
+    
+    def count(name, **labels):
+        return metrics.counters.get((name, tuple(sorted(labels.items()))), 0)
+    
+    def avg_ms(summaries):
+        count_total = sum(c for c, _, _ in summaries)
+        return 1000 * sum(t for _, t, _ in summaries) / count_total if count_total else 0.0
+    
+    handler_lines = ''.join(
+        f'  /{dict(labels)["command"]}: {c} × {1000 * t / c:.1f} ms (max {1000 * m:.0f} ms)\n'
+        for (name, labels), (c, t, m) in sorted(metrics.summaries.items())
+        if name == 'handler_seconds'
+    ) or '  brak\n'
+    fetches = [v for (n, _), v in metrics.summaries.items() if n == 'calendar_fetch_seconds']
+    sweeps = [v for (n, _), v in metrics.summaries.items() if n == 'sweep_seconds']
+    fetch_bytes = sum(v for (n, _), v in metrics.counters.items() if n == 'calendar_fetch_bytes_total')
+    deadlines = sum(v for (n, _), v in metrics.counters.items() if n == 'handler_deadline_exceeded_total')
+    failing = sorted(f'{m}/{r}' for m, r in _calendar_circuits)
+    
+    await update.message.reply_text(
+        f'📊 Statystyki bota\n\n'
+        f'👥 Użytkownicy: {metrics.gauges[("users", ())]} '
+        f'(subskrypcje: {metrics.gauges[("subscribers", ())]})\n\n'
+        f'📅 Kalendarze:\n'
+        f'  cache: {count("calendar_cache_total", result="hit")} trafień, '
+        f'{count("calendar_cache_total", result="stale")} nieaktualnych, '
+        f'{count("calendar_cache_total", result="miss")} chybień\n'
+        f'  pobrania: {sum(c for c, _, _ in fetches)} × {avg_ms(fetches):.0f} ms, {fetch_bytes / 1024:.0f} KiB\n'
+        f'  niedostępne: {", ".join(failing) or "brak"} ({deadlines} × przekroczony czas odpowiedzi)\n\n'
+        f'✉️ Wiadomości: {count("messages_total", result="sent")} wysłanych, '
+        f'{count("messages_total", result="failed")} błędów, '
+        f'{count("messages_total", result="unreachable")} niedostępnych, '
+        f'{count("telegram_retry_after_total")} × RetryAfter\n'
+        f'⏱️ Rozsyłki: {sum(c for c, _, _ in sweeps)} × {avg_ms(sweeps) / 1000:.1f} s\n'
+        f'🔁 Opóźnienie pętli: {1000 * metrics.gauges.get(("event_loop_lag_seconds", ()), 0):.1f} ms\n\n'
+        f'⌨️ Komendy:\n{handler_lines}'
+    )
+
+
+async def post_init(application: Application) -> None:
+    """Start background services once the event loop is running."""
+    application.bot_data['loop_monitor'] = asyncio.create_task(monitor_event_loop())
+    if METRICS_PORT:
+        application.bot_data['metrics_server'] = await asyncio.start_server(
+            _serve_metrics, METRICS_HOST, int(METRICS_PORT)
+        )
+        logger.info(f'Metrics available at http://{METRICS_HOST}:{METRICS_PORT}/metrics')
+
+
+async def post_shutdown(application: Application) -> None:
+    """Stop background services and release connections."""
+    application.bot_data['loop_monitor'].cancel()
+    if application.bot_data.get('leader'):
+        await asyncio.to_thread(outbox.release_lease, 'notifier', INSTANCE_ID)
+    server = application.bot_data.get('metrics_server')
+    if server is not None:
+        server.close()
+        await server.wait_closed()
+    await close_http_client()
+
+
+async def _serve_webhook(application, secret, path, reader, writer):
+    """Accept one webhook POST from Telegram and queue its update."""
+    requests_in_flight = application.bot_data['webhook_requests']
+    task = asyncio.current_task()
+    requests_in_flight.add(task)
+    try:
+        request = await asyncio.wait_for(_read_http_request(reader), HTTP_READ_TIMEOUT)
+        if request is None:
+            await _write_http_response(writer, '400 Bad Request')
+            return
+        method, request_path, headers, body = request
+        if request_path != path:
+            await _write_http_response(writer, '404 Not Found')
+            return
+        if method != 'POST':
+            await _write_http_response(writer, '405 Method Not Allowed')
+            return
+        if not hmac.compare_digest(headers.get('x-telegram-bot-api-secret-token', ''), secret):
+            metrics.inc('webhook_requests_total', result='forbidden')
+            await _write_http_response(writer, '403 Forbidden')
+            return
+        try:
+            update = Update.de_json(json.loads(body), application.bot)
+        except Exception as e:
+            logger.warning(f'Invalid webhook payload: {e}')
+            metrics.inc('webhook_requests_total', result='invalid')
+            await _write_http_response(writer, '400 Bad Request')
+            return
+        
+        await application.update_queue.put(update)
+        metrics.inc('webhook_requests_total', result='ok')
+        await _write_http_response(writer, '200 OK')
+    except Exception as e:
+        logger.debug(f'Webhook request failed: {e}')
+    finally:
+        requests_in_flight.discard(task)
+        writer.close()
+
+
+async def run_webhook(application: Application) -> None:
+    """Run the bot with a local webhook server instead of long polling.
+    
+    On SIGINT/SIGTERM the server stops accepting connections, requests
+    already being read are finished, and Application.stop() then processes
+    every queued update before shutting down. The webhook stays registered,
+    so Telegram keeps new updates until the bot is back.
+    """
+    secret = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    path = urlparse(WEBHOOK_URL).path or '/'
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    
+    await application.initialize()
+    await post_init(application)
+    application.bot_data['webhook_requests'] = set()
+    server = await asyncio.start_server(
+        functools.partial(_serve_webhook, application, secret, path), WEBHOOK_LISTEN, WEBHOOK_PORT
+    )
+    await application.bot.set_webhook(WEBHOOK_URL, secret_token=secret, allowed_updates=ALLOWED_UPDATES)
+    await application.start()
+    logger.info(f'Webhook server listening on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{path}')
+    
+    try:
+        await stop_event.wait()
+    finally:
+        logger.info('Stopping webhook server, draining pending updates...')
+        server.close()
+        await server.wait_closed()
+        in_flight = application.bot_data['webhook_requests']
+        if in_flight:
+            await asyncio.wait(in_flight, timeout=HTTP_READ_TIMEOUT)
+        await application.stop()
+        await application.shutdown()
+        await post_shutdown(application)
+
+
+async def run_worker(token, shard):
+    """Send queued reminders for one shard until SIGINT/SIGTERM.
+    
+    Each worker gets an equal share of BROADCAST_RATE, so all of them
+    together stay within Telegram's global limit.
+    """
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    
+    await asyncio.to_thread(outbox.requeue, shard)
+    results = {}
+    async with Bot(token) as worker_bot:
+        broadcaster = Broadcaster(
+            worker_bot,
+            rate=BROADCAST_RATE / NOTIFIER_WORKERS,
+            concurrency=max(1, BROADCAST_CONCURRENCY // NOTIFIER_WORKERS),
+            on_sent=lambda chat_id: results.__setitem__(chat_id, 'sent'),
+            on_failed=lambda chat_id: results.__setitem__(chat_id, 'failed'),
+            on_unreachable=lambda chat_id: results.__setitem__(chat_id, 'unreachable')
+        )
+        logger.info(f'Notifier worker {shard}/{NOTIFIER_WORKERS} started')
+        while not stop_event.is_set():
+            rows = await asyncio.to_thread(outbox.claim, shard)
+            if not rows:
                 try:
-                    await context.bot.send_message(chat_id=user['chat_id'], text=message)
-                    logger.info(f'Sent notification to user {user["user_id"]} for {pickup["type"]}')
-                except Exception as e:
-                    logger.error(f'Error sending notification to user {user["user_id"]}: {e}')
+                    await asyncio.wait_for(stop_event.wait(), NOTIFIER_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            results.clear()
+            stats = await broadcaster.send_all((chat_id, text) for _, chat_id, text in rows)
+            await asyncio.to_thread(
+                outbox.complete, [(results.get(chat_id, 'failed'), row_id) for row_id, chat_id, _ in rows]
+            )
+            logger.info(f'Worker {shard}: sent batch of {len(rows)}, totals {stats}')
+    logger.info(f'Notifier worker {shard} stopped')
 
 
 def main() -> None:
@@ -461,41 +2578,83 @@ def main() -> None:
         logger.error('TELEGRAM_BOT_TOKEN not found in environment variables!')
         return
     
-    # Load user settings from file
+    global outbox
+    outbox = Outbox()
+    
+    # `python bot.py worker <shard>` only sends reminders queued for its shard
+    if sys.argv[1:2] == ['worker']:
+        shard = int(sys.argv[2]) if len(sys.argv) > 2 else -1
+        if not 0 <= shard < NOTIFIER_WORKERS:
+            logger.error(f'Usage: bot.py worker <shard>, with shard in 0..NOTIFIER_WORKERS-1 (NOTIFIER_WORKERS={NOTIFIER_WORKERS})')
+            return
+        asyncio.run(run_worker(token, shard))
+        return
+    
+    # Load user settings and delivered reminders from file
     load_user_settings()
+    delivery_ledger.load()
+    
+    # Serve the last known calendars until fresh ones are downloaded
+    load_calendar_snapshot()
     
     # Create the Application
-    application = Application.builder().token(token).build()
-    
-    # Add conversation handler for rejon selection
-    conv_handler = ConversationHandler(
-        entry_points=[CommandHandler('start', start), CommandHandler('zmien', change_rejon)],
-        states={
-            REJON_SELECT: [MessageHandler(filters.TEXT & ~filters.COMMAND, rejon_selected)],
-        },
-        fallbacks=[CommandHandler('cancel', cancel)],
-    )
+    application = Application.builder().token(token).post_init(post_init).post_shutdown(post_shutdown).build()
     
-    application.add_handler(conv_handler)
+    # Rejon selection, schedule paging and stop/resubscribe use inline
+    # buttons that edit their message in place. Typing a rejon name still
+    # works in private chats right after /start or /zmien (e.g. from the old
+    # reply keyboard).
+    application.add_handler(CommandHandler('start', start))
+    application.add_handler(CommandHandler('zmien', change_rejon))
+    application.add_handler(CommandHandler('cancel', cancel))
+    application.add_handler(CallbackQueryHandler(municipality_selected, pattern=r'^gmina:'))
+    application.add_handler(CallbackQueryHandler(rejon_selected, pattern=r'^rejon:[^:]+:'))
+    application.add_handler(CallbackQueryHandler(show_schedule, pattern=r'^page:\d+$'))
+    application.add_handler(CallbackQueryHandler(change_rejon, pattern=r'^zmien$'))
+    application.add_handler(CallbackQueryHandler(stop, pattern=r'^stop$'))
+    application.add_handler(CallbackQueryHandler(resubscribe, pattern=r'^sub$'))
+    application.add_handler(CallbackQueryHandler(reminder_settings, pattern=r'^(przypomnienie|time:\d{1,4}|lead:[01])$'))
+    rejon_names = '|'.join(sorted({re.escape(region) for m in SOURCES.values() for region in m.regions}))
+    application.add_handler(MessageHandler(
+        filters.ChatType.PRIVATE & filters.Regex(rf'^\s*({rejon_names})\s*$'), rejon_selected
+    ))
     application.add_handler(CommandHandler('harmonogram', show_schedule))
     application.add_handler(CommandHandler('nastepny', show_next_pickup))
+    application.add_handler(CommandHandler('przypomnienie', reminder_settings))
     application.add_handler(CommandHandler('stop', stop))
     application.add_handler(CommandHandler('help', help_command))
     application.add_handler(CommandHandler('test', test_notification))
+    application.add_handler(CommandHandler('stats', stats_command))
     
-    # Schedule daily notifications check at 9:00 AM and 6:00 PM
+    # Reminders go out at each subscriber's chosen minute (one timer walking
+    # the upcoming slots); failed deliveries are retried every hour
     job_queue = application.job_queue
-    job_queue.run_daily(check_and_send_notifications, time=datetime.strptime('09:00', '%H:%M').time(), name='morning_check')
-    job_queue.run_daily(check_and_send_notifications, time=datetime.strptime('18:00', '%H:%M').time(), name='evening_check')
+    reminder_scheduler.start(job_queue)
+    job_queue.run_repeating(check_and_send_notifications, interval=3600, first=3600, name='retry_check',
+                            data={'retry_only': True})
     
-    # Run an immediate check when bot starts (in case bot was restarted)
-    job_queue.run_once(check_and_send_notifications, when=5)  # Run after 5 seconds
+    # Only the instance holding the notifier lease sends reminders. Taking the
+    # lease (right away on a single instance) triggers a check 5 seconds later,
+    # in case the bot was restarted
+    job_queue.run_repeating(renew_leadership, interval=NOTIFIER_LEASE_RENEW, first=0, name='notifier_lease')
+    if NOTIFIER_WORKERS:
+        job_queue.run_repeating(collect_deliveries, interval=NOTIFIER_COLLECT_INTERVAL, first=NOTIFIER_COLLECT_INTERVAL,
+                                name='collect_deliveries')
+    
+    # Keep calendars fresh in the background: right away and on a jittered
+    # interval (the reminder scheduler adds one shortly before each sweep)
+    job_queue.run_once(refresh_calendars, when=0, name='calendar_refresh', data={'repeat': True})
+    
+    if METRICS_FILE:
+        job_queue.run_repeating(write_metrics_file, interval=60, first=60, name='metrics_file')
     
     # Start the Bot
     logger.info('Starting bot...')
-    logger.info('Notification checks scheduled for 9:00 AM and 6:00 PM daily')
-    logger.info('Running initial notification check in 5 seconds...')
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    logger.info(f'Reminders scheduled for {len(reminder_scheduler.queued)} distinct times, failed ones retried hourly')
+    if WEBHOOK_URL:
+        asyncio.run(run_webhook(application))
+    else:
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,65 @@
+"""Checks the streaming calendar parser against icalendar.
+
+    python -m unittest test_parser
+"""
+
+import unittest
+
+from icalendar import Calendar
+
+import bot
+
+
+def _edge_calendar(*events):
+    lines = ['BEGIN:VCALENDAR', 'VERSION:2.0', 'PRODID:-//test_parser//EN']
+    for event in events:
+        lines += ['BEGIN:VEVENT', *event, 'END:VEVENT']
+    lines.append('END:VCALENDAR')
+    return ('\r\n'.join(lines) + '\r\n').encode()
+
+
+# Inputs the generated benchmark fixtures don't cover; the parser must agree
+# with icalendar on each of them
+PARSER_EDGE_CASES = {
+    'tzid': _edge_calendar(['DTSTART;TZID=Europe/Warsaw:20251126T070000', 'SUMMARY:ZMIESZANE']),
+    'utc': _edge_calendar(['DTSTART:20251126T230000Z', 'SUMMARY:SEGREGOWANE']),
+    'floating_datetime': _edge_calendar(['DTSTART:20251127T060000', 'SUMMARY:GABARYTY']),
+    'escaping': _edge_calendar(['DTSTART;VALUE=DATE:20251126', 'SUMMARY:Papier\\, szkło\\; metale\\nplastik \\\\ bio']),
+    'folding': _edge_calendar([
+        'DTSTART;VALUE=DATE:20251126', 'SUMMARY:Odpady wielkogabarytowe i zużyty sprzęt elektryczn', ' y oraz elektroniczny'
+    ]),
+    'non_ascii': _edge_calendar(['DTSTART;VALUE=DATE:20251126', 'SUMMARY:Popiół i odpady zielone – ogrodowe']),
+    'valarm': _edge_calendar([
+        'DTSTART;VALUE=DATE:20251126', 'SUMMARY:BIO',
+        'BEGIN:VALARM', 'ACTION:DISPLAY', 'DESCRIPTION:Przypomnienie', 'TRIGGER:-PT15H', 'END:VALARM',
+    ]),
+    'missing_dtstart': _edge_calendar(
+        ['SUMMARY:Bez daty', 'UID:no-date@google.com'],
+        ['DTSTART;VALUE=DATE:20251126', 'SUMMARY:ZMIESZANE'],
+    ),
+    'missing_summary': _edge_calendar(['DTSTART;VALUE=DATE:20251126']),
+    'lf_line_endings': _edge_calendar(['DTSTART;VALUE=DATE:20251126', 'SUMMARY:ZMIESZANE']).replace(b'\r\n', b'\n'),
+}
+
+
+def icalendar_events(content):
+    """What _parse_calendar should return for `content`, according to icalendar."""
+    events = []
+    for component in Calendar.from_ical(content).walk():
+        if component.name == 'VEVENT' and component.get('dtstart'):
+            event_date = component.get('dtstart').dt
+            if hasattr(event_date, 'date'):
+                event_date = event_date.date()
+            events.append({'date': event_date, 'type': str(component.get('summary', ''))})
+    return events
+
+
+class ParserTest(unittest.TestCase):
+    def test_edge_cases_match_icalendar(self):
+        for name, content in PARSER_EDGE_CASES.items():
+            with self.subTest(name):
+                self.assertEqual(bot._parse_calendar(content), icalendar_events(content))
+
+
+if __name__ == '__main__':
+    unittest.main()